@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""
+Compare the segment concatenation methods on a synthetic download folder.
+
+Example:
+    python benchmarks/concat_benchmark.py -n 3000 -s 150
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from livestream_dl.concat import concat_files, KERNEL_COPY_METHODS    # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark segment concatenation.')
+    parser.add_argument('-n', dest='count', type=int, default=2000, help='Number of segments. Default 2000.')
+    parser.add_argument('-s', dest='size', type=int, default=100, help='Segment size in KB. Default 100.')
+    parser.add_argument('-r', dest='repeat', type=int, default=3, help='Runs per method. Default 3.')
+    parser.add_argument('-d', dest='tmp_dir', help='Folder to create the test files in.')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='concat_benchmark', dir=args.tmp_dir)
+    try:
+        segments = []
+        for i in range(args.count):
+            segment = os.path.join(work_dir, '1234-%d.m4v' % i)
+            with open(segment, 'wb') as f:
+                f.write(os.urandom(args.size * 1024))
+            segments.append(segment)
+        total_mb = args.count * args.size / 1024.0
+        print('%d segments x %dKB = %.1fMB in %s' % (args.count, args.size, total_mb, work_dir))
+
+        output_file = os.path.join(work_dir, 'assembled.tmp')
+        expected_size = args.count * args.size * 1024
+        for method in ['buffered'] + [name for name, _ in KERNEL_COPY_METHODS]:
+            timings = []
+            for _ in range(args.repeat):
+                start = time.time()
+                concat_files(segments, output_file, method=method)
+                timings.append(time.time() - start)
+                assert os.path.getsize(output_file) == expected_size
+                os.remove(output_file)
+            best = min(timings)
+            print('%-16s best %.3fs  avg %.3fs  %.1fMB/s' % (
+                method, best, sum(timings) / len(timings), total_mb / best if best else 0))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
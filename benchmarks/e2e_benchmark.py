@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+"""
+End-to-end benchmarks against a local fake DASH origin and a stub api client.
+See harness.py. The synthetic segments are not playable media, so a fake ffmpeg
+that concatenates its inputs is used for muxing.
+
+Scenarios:
+
+- run: ``livestream_dl`` for a live user, from lookup to the final files, with comments
+- downloader: the live Downloader on its own, with and without incremental assembly
+- comments: live comments collection only
+- assemble: ``livestream_as`` on the folder left by the downloader scenario
+
+Metrics:
+
+- time to first segment: from start to the first media segment being served
+- segment lag: from a segment becoming available to it being fetched
+- throughput: bytes served between the first and last segment fetch
+- stitch: time taken by stitch(), and from the stream end to the final files
+- comment capture: unique comments collected out of all comments posted
+
+Example:
+    python benchmarks/e2e_benchmark.py -n 20 -s downloader assemble
+"""
+import os
+import sys
+import json
+import glob
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+from contextlib import contextmanager
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '..'))
+sys.path.insert(0, BENCHMARKS_DIR)
+
+from harness import FakeOrigin, StubClient, write_fake_ffmpeg    # noqa: E402
+
+SCENARIOS = ('run', 'downloader', 'comments', 'assemble')
+
+
+class CommentsConfig(object):
+    commenters = frozenset()
+    collectcomments = True
+    commentkeywords = ()
+    excludecommenters = frozenset()
+
+
+def make_origin(args):
+    return FakeOrigin(
+        segment_duration=args.segment_duration, segments=args.segments,
+        resolutions=[(0, 504, 896), (args.segments * 2 // 3, 360, 640)],
+        video_size=args.segment_size * 1024).start()
+
+
+def stub_client_class(origin, args):
+    return type('BenchmarkClient', (StubClient, ), {
+        'origin': origin, 'comments_per_sec': args.comment_rate, 'page_size': args.page_size})
+
+
+@contextmanager
+def timed_method(cls, name):
+    """Record the duration of every call to cls.name"""
+    durations = []
+    original = getattr(cls, name)
+
+    def wrapper(*a, **kw):
+        start = time.time()
+        try:
+            return original(*a, **kw)
+        finally:
+            durations.append(time.time() - start)
+
+    setattr(cls, name, wrapper)
+    try:
+        yield durations
+    finally:
+        setattr(cls, name, original)
+
+
+def download_metrics(origin, start_time):
+    lags = list(origin.segment_lag.values())
+    transfer_duration = (origin.last_segment_time or 0) - (origin.first_segment_time or 0)
+    return [
+        ('time to first segment', '%.2fs' % ((origin.first_segment_time or start_time) - start_time)),
+        ('segments fetched', '%d/%d' % (len(lags), origin.segments)),
+        ('segment lag avg/max', '%.2fs / %.2fs' % (sum(lags) / max(1, len(lags)), max(lags or [0]))),
+        ('throughput', '%.1f KB/s' % (origin.bytes_served / 1024.0 / transfer_duration if transfer_duration else 0)),
+        ('mpd requests', '%d' % origin.mpd_requests),
+    ]
+
+
+def comment_metrics(client_class, comments, api_calls=None):
+    posted = client_class.comments_until(client_class.origin.end_time)
+    unique = len(set([c['pk'] for c in comments]))
+    metrics = [('comment capture', '%d/%d (%.1f%%)' % (unique, posted, 100.0 * unique / posted if posted else 0))]
+    if api_calls is not None:
+        metrics.append(('comment api calls', '%d' % api_calls))
+    return metrics
+
+
+def scenario_run(args, work_dir):
+    import instagram_private_api
+    from livestream_dl import download
+    from livestream_dl.live import LiveDownloader
+    from livestream_dl.comments import CommentsDownloader
+
+    output_dir = os.path.join(work_dir, 'run')
+    origin = make_origin(args)
+    client_class = stub_client_class(origin, args)
+    original_client = instagram_private_api.Client
+    instagram_private_api.Client = client_class
+    sys.argv = [
+        'livestream_dl', '-ignoreconfig', '-u', 'benchmark', '-p', 'benchmark',
+        '-settings', os.path.join(work_dir, 'settings.json'), '-outputdir', output_dir,
+        '-nousercache', '-collectcomments', 'benchmark_user']
+    start = time.time()
+    try:
+        with timed_method(LiveDownloader, 'stitch') as stitch_durations:
+            try:
+                download.run()
+            except SystemExit:
+                pass
+    finally:
+        instagram_private_api.Client = original_client
+        origin.stop()
+    end = time.time()
+
+    comments = []
+    for comments_file in glob.glob(os.path.join(output_dir, '*_comments.json')):
+        comments.extend(CommentsDownloader.load(comments_file)[1])
+    return download_metrics(origin, start) + [
+        ('stitch', '%.2fs' % sum(stitch_durations)),
+        ('files ready after stream end', '%.2fs' % (end - origin.end_time)),
+        ('output files', '%d' % len(glob.glob(os.path.join(output_dir, '*.mp4')))),
+    ] + comment_metrics(client_class, comments)
+
+
+def scenario_downloader(args, work_dir, incremental=False):
+    from livestream_dl.live import LiveDownloader
+    from livestream_dl.net import create_session
+
+    output_dir = os.path.join(work_dir, 'downloader_incremental' if incremental else 'downloader')
+    origin = make_origin(args)
+    dl = LiveDownloader(
+        mpd=origin.mpd_url, output_dir=output_dir,
+        callback_check=lambda: origin.has_ended,
+        duplicate_etag_retry=60, incremental=incremental, session=create_session())
+    start = time.time()
+    try:
+        dl.run()
+        stitch_start = time.time()
+        generated_files = dl.stitch(os.path.join(output_dir, 'output.mp4'), cleartempfiles=False)
+        end = time.time()
+    finally:
+        origin.stop()
+
+    # meta file for the assemble scenario
+    broadcast = origin.broadcast_info()
+    broadcast['delay'] = 0
+    broadcast['segments'] = dl.segment_meta
+    broadcast['initial_buffered_duration'] = dl.initial_buffered_duration
+    with open(os.path.join(output_dir, 'broadcast.json'), 'w') as f:
+        json.dump(broadcast, f)
+
+    return download_metrics(origin, start) + [
+        ('stitch', '%.2fs' % (end - stitch_start)),
+        ('files ready after stream end', '%.2fs' % (end - origin.end_time)),
+        ('output files', '%d' % len(generated_files)),
+        ('download requests', str(dl.session.stats)),
+    ]
+
+
+def scenario_comments(args, work_dir):
+    from instagram_private_api import ClientError
+    from livestream_dl.comments import CommentsDownloader
+
+    origin = make_origin(args)
+    client_class = stub_client_class(origin, args)
+    client = client_class()
+    cdl = CommentsDownloader(
+        api=client, broadcast=origin.broadcast_info(),
+        destination_file=os.path.join(work_dir, 'comments.json'),
+        user_config=CommentsConfig(), logger=logging.getLogger('e2e_benchmark'))
+    first_comment_created_at = 0
+    try:
+        while not cdl.aborted:
+            first_comment_created_at = cdl.get_live(first_comment_created_at)
+    except ClientError:
+        # media has been deleted, i.e. stream has ended
+        pass
+    finally:
+        origin.stop()
+    return comment_metrics(client_class, cdl.comments, client.calls.get('broadcast_comments', 0))
+
+
+def scenario_assemble(args, work_dir):
+    from livestream_dl import assemble
+
+    download_dir = os.path.join(work_dir, 'downloader')
+    if not os.path.isfile(os.path.join(download_dir, 'broadcast.json')):
+        scenario_downloader(args, work_dir)
+    metrics = []
+    for options in ([], ['-pipe', '-j', '2']):
+        output_file = os.path.join(work_dir, 'assembled%s.mp4' % ''.join(options).replace('-', '_'))
+        sys.argv = [
+            'livestream_as', os.path.join(download_dir, 'broadcast.json'),
+            '-o', download_dir, '-f', output_file] + options
+        start = time.time()
+        assemble.main()
+        metrics.append((
+            'livestream_as %s' % (' '.join(options) or '(default)'),
+            '%.2fs, %d file(s)' % (time.time() - start, len(glob.glob(output_file.replace('.mp4', '*.mp4'))))))
+    return metrics
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end benchmarks against a local fake broadcast.')
+    parser.add_argument('-s', dest='scenarios', nargs='*', choices=SCENARIOS, default=SCENARIOS,
+                        help='Scenarios to run. Default all.')
+    parser.add_argument('-n', dest='segments', type=int, default=20, help='Segments per broadcast. Default 20.')
+    parser.add_argument('-t', dest='segment_duration', type=float, default=1.0,
+                        help='Segment duration in seconds. Default 1.')
+    parser.add_argument('-size', dest='segment_size', type=int, default=150,
+                        help='Video segment size in KB. Default 150.')
+    parser.add_argument('-rate', dest='comment_rate', type=float, default=10.0,
+                        help='Comments posted per second. Default 10.')
+    parser.add_argument('-page', dest='page_size', type=int, default=30,
+                        help='Max comments returned per comments api call. Default 30.')
+    parser.add_argument('-d', dest='tmp_dir', help='Folder to create the test files in.')
+    parser.add_argument('-v', dest='verbose', action='store_true', help='Show the downloader logs.')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='e2e_benchmark', dir=args.tmp_dir)
+    os.environ['FFMPEG_BINARY'] = write_fake_ffmpeg(work_dir)
+    if not args.verbose:
+        logging.disable(logging.WARNING)
+
+    try:
+        results = []
+        for scenario in args.scenarios:
+            if scenario == 'downloader':
+                results.append(('downloader', scenario_downloader(args, work_dir)))
+                results.append(('downloader -incremental', scenario_downloader(args, work_dir, incremental=True)))
+            else:
+                results.append((scenario, globals()['scenario_%s' % scenario](args, work_dir)))
+            sys.stdout.write('.')
+            sys.stdout.flush()
+        print('')
+
+        for scenario, metrics in results:
+            print(scenario)
+            for name, value in metrics:
+                print('    %-30s %s' % (name, value))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,348 @@
+"""
+Local stand-ins for an Instagram live broadcast, for end-to-end benchmarks.
+
+- ``FakeOrigin``: HTTP server for a synthetic live DASH stream, with a moving
+  segment timeline, resolution switches and a stream end.
+- ``StubClient``: replaces ``instagram_private_api.Client`` with scripted
+  ``user_story_feed``, ``broadcast_heartbeat_and_viewercount`` and
+  ``broadcast_comments`` responses for a FakeOrigin broadcast.
+- ``write_fake_ffmpeg()``: a stand-in ffmpeg that just concatenates its inputs,
+  since the synthetic segments are not playable media.
+"""
+import os
+import re
+import sys
+import math
+import time
+import struct
+import threading
+try:
+    # py2
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    # py3
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+TIMESCALE = 1000
+
+
+def box(box_type, payload):
+    """Build an ISO BMFF box."""
+    return struct.pack('>I4s', 8 + len(payload), box_type.encode('latin-1')) + payload
+
+
+def init_segment(width, height):
+    """A minimal init segment with a video track, enough for livestream_dl.mp4 to read the resolution."""
+    tkhd = box('tkhd', struct.pack('>B3x', 0) + b'\0' * 20 + b'\0' * 52 + struct.pack('>II', width << 16, height << 16))
+    hdlr = box('hdlr', b'\0' * 8 + b'vide' + b'\0' * 12)
+    avc1 = box('avc1', b'\0' * 24 + struct.pack('>HH', width, height) + b'\0' * 50)
+    stsd = box('stsd', struct.pack('>II', 0, 1) + avc1)
+    stbl = box('stbl', stsd)
+    minf = box('minf', stbl)
+    mdia = box('mdia', hdlr + minf)
+    trak = box('trak', tkhd + mdia)
+    return box('ftyp', b'iso5\0\0\0\1') + box('moov', trak)
+
+
+def media_segment(n, size):
+    """A media segment of about size bytes."""
+    return box('moof', struct.pack('>I', n)) + box('mdat', b'\0' * max(0, size - 20))
+
+
+class FakeOrigin(object):
+    """
+    Serves a synthetic live stream that starts when ``start()`` is called.
+
+    Segment n becomes available ``(n + 1 - preroll) * segment_duration`` seconds
+    after the start, so that ``preroll`` segments are available right away like
+    the initial buffer of a real broadcast. Once all the segments are available,
+    the mpd is served with a long ``Cache-Control: max-age``, which the
+    downloader takes as the stream end.
+    """
+
+    def __init__(self, stream_id='17900000000000001', segment_duration=1.0, segments=30,
+                 window=10, preroll=5, resolutions=None, video_size=150 * 1024, audio_size=16 * 1024):
+        """
+
+        :param stream_id: numeric broadcast/stream ID
+        :param segment_duration: seconds per segment
+        :param segments: total number of segments in the stream
+        :param window: number of segments listed in the mpd timeline
+        :param preroll: number of segments already available at the start
+        :param resolutions: list of (first segment index, width, height), e.g. [(0, 504, 896), (20, 360, 640)]
+        :param video_size: bytes per video segment
+        :param audio_size: bytes per audio segment
+        """
+        self.stream_id = stream_id
+        self.segment_duration = segment_duration
+        self.segments = segments
+        self.window = window
+        self.preroll = preroll
+        self.resolutions = sorted(resolutions or [(0, 504, 896)])
+        self.video_size = video_size
+        self.audio_size = audio_size
+
+        self.lock = threading.Lock()
+        self.start_time = None
+        self.mpd_requests = 0
+        self.bytes_served = 0
+        self.first_segment_time = None
+        self.last_segment_time = None
+        # segment index => seconds between the segment becoming available and it being served
+        self.segment_lag = {}
+
+        origin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                origin.handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.thread = None
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:%d/' % self.server.server_port
+
+    @property
+    def mpd_url(self):
+        return self.base_url + 'live/%s.mpd' % self.stream_id
+
+    def start(self):
+        self.start_time = time.time()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @property
+    def published_time(self):
+        return int(self.start_time - self.preroll * self.segment_duration)
+
+    @property
+    def end_time(self):
+        return self.available_time(self.segments - 1)
+
+    def available_time(self, n):
+        return self.start_time + (n + 1 - self.preroll) * self.segment_duration
+
+    def available_count(self, now=None):
+        elapsed = (now or time.time()) - self.start_time
+        return max(0, min(self.segments, int(math.floor(elapsed / self.segment_duration)) + self.preroll))
+
+    @property
+    def has_ended(self):
+        return self.available_count() >= self.segments
+
+    def resolution(self, n):
+        """(width, height) of segment n"""
+        current = self.resolutions[0][1:]
+        for first_index, width, height in self.resolutions:
+            if n >= first_index:
+                current = (width, height)
+        return current
+
+    def mpd(self, count):
+        ticks = int(self.segment_duration * TIMESCALE)
+        first = max(0, count - self.window)
+        timeline = ''.join([
+            '<S t="%d" d="%d"/>' % (n * ticks, ticks) for n in range(first, count)])
+        width, height = self.resolution(max(0, count - 1))
+        return (
+            '<?xml version="1.0"?>'
+            '<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="dynamic" minimumUpdatePeriod="PT1S">'
+            '<Period id="0">'
+            '<AdaptationSet mimeType="video/mp4">'
+            '<Representation id="v{width}" mimeType="video/mp4" width="{width}" height="{height}" bandwidth="{vbw}">'
+            '<SegmentTemplate timescale="{timescale}" initialization="../{id}-init.m4v" media="../{id}-$Time$.m4v">'
+            '<SegmentTimeline>{timeline}</SegmentTimeline></SegmentTemplate></Representation>'
+            '</AdaptationSet>'
+            '<AdaptationSet mimeType="audio/mp4">'
+            '<Representation id="a" mimeType="audio/mp4" audioSamplingRate="44100" bandwidth="{abw}">'
+            '<SegmentTemplate timescale="{timescale}" initialization="../{id}-init.m4a" media="../{id}-$Time$.m4a">'
+            '<SegmentTimeline>{timeline}</SegmentTimeline></SegmentTemplate></Representation>'
+            '</AdaptationSet>'
+            '</Period></MPD>').format(
+                id=self.stream_id, width=width, height=height, timescale=TIMESCALE, timeline=timeline,
+                vbw=int(self.video_size * 8 / self.segment_duration),
+                abw=int(self.audio_size * 8 / self.segment_duration))
+
+    def handle(self, request):
+        now = time.time()
+        path = request.path.split('?')[0]
+        headers = {'Content-Type': 'application/octet-stream'}
+        body = None
+
+        if path.endswith('.mpd'):
+            count = self.available_count(now)
+            with self.lock:
+                self.mpd_requests += 1
+            body = self.mpd(count).encode('utf-8')
+            headers['Content-Type'] = 'application/dash+xml'
+            headers['Cache-Control'] = 'max-age=60' if count >= self.segments else 'no-cache'
+        else:
+            mobj = re.match(r'.*/(?P<id>[0-9]+)-(?P<t>[0-9]+|init)\.(?P<ext>m4v|m4a)$', path)
+            if mobj and mobj.group('id') == self.stream_id:
+                if mobj.group('t') == 'init':
+                    count = max(1, self.available_count(now))
+                    body = init_segment(*self.resolution(count - 1)) if mobj.group('ext') == 'm4v' else box(
+                        'ftyp', b'M4A \0\0\0\1') + box('moov', b'')
+                else:
+                    n = int(mobj.group('t')) // int(self.segment_duration * TIMESCALE)
+                    if n < self.available_count(now):
+                        is_video = mobj.group('ext') == 'm4v'
+                        body = media_segment(n, self.video_size if is_video else self.audio_size)
+                        with self.lock:
+                            if self.first_segment_time is None:
+                                self.first_segment_time = now
+                            self.last_segment_time = now
+                            if is_video:
+                                self.segment_lag[n] = max(0.0, now - self.available_time(n))
+
+        if body is None:
+            request.send_response(404)
+            request.send_header('Content-Length', '0')
+            request.end_headers()
+            return
+        request.send_response(200)
+        for k, v in headers.items():
+            request.send_header(k, v)
+        request.send_header('Content-Length', str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+        with self.lock:
+            self.bytes_served += len(body)
+
+    def broadcast_info(self, username='benchmark_user', user_id=123456789):
+        """Broadcast info as found in a user story feed response."""
+        return {
+            'id': int(self.stream_id),
+            'broadcast_status': 'active',
+            'dash_playback_url': self.mpd_url,
+            'published_time': self.published_time,
+            'viewer_count': 100,
+            'broadcast_owner': {'pk': user_id, 'username': username},
+        }
+
+
+class StubClient(object):
+    """
+    Stands in for ``instagram_private_api.Client``, without any network calls,
+    for a FakeOrigin broadcast.
+
+    Set the ``origin`` class attribute (e.g. on a subclass) before use. Without
+    an origin, the user is not live. Comments are generated at ``comments_per_sec`` from verified users and each
+    ``broadcast_comments`` call returns at most the ``page_size`` newest
+    comments, so comments can be missed if polled too slowly.
+    """
+
+    origin = None
+    comments_per_sec = 5.0
+    page_size = 30
+
+    def __init__(self, username='benchmark', password='', **kwargs):
+        self.authenticated_user_name = username
+        self.user_agent = 'Instagram 10.26.0 Android'
+        self.settings = {}
+        self.calls = {}
+        self.lock = threading.Lock()
+        if kwargs.get('on_login'):
+            kwargs['on_login'](self)
+
+    def _count(self, name):
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def username_info(self, user_name):
+        self._count('username_info')
+        return {'user': {'pk': 123456789, 'username': user_name}}
+
+    def user_story_feed(self, user_id):
+        self._count('user_story_feed')
+        if not self.origin or self.origin.has_ended:
+            return {'status': 'ok'}
+        return {'broadcast': self.origin.broadcast_info(), 'status': 'ok'}
+
+    def broadcast_heartbeat_and_viewercount(self, broadcast_id):
+        self._count('broadcast_heartbeat_and_viewercount')
+        return {
+            'broadcast_status': 'stopped' if self.origin.has_ended else 'active',
+            'viewer_count': 100, 'status': 'ok'}
+
+    @classmethod
+    def comments_until(cls, until):
+        """Number of comments posted from the broadcast published time until the timestamp."""
+        elapsed = until - cls.origin.published_time
+        return max(0, int(math.floor(elapsed * cls.comments_per_sec)))
+
+    @classmethod
+    def comment(cls, n):
+        created_at = cls.origin.published_time + n / float(cls.comments_per_sec)
+        user_id = 1000 + n % 50
+        return {
+            'pk': 18000000000000000 + n,
+            'user_id': user_id,
+            'created_at': created_at,
+            'created_at_utc': int(created_at),
+            'text': 'comment %d' % n,
+            'type': 0,
+            'user': {'pk': user_id, 'username': 'user%d' % user_id, 'is_verified': True},
+        }
+
+    def broadcast_comments(self, broadcast_id, last_comment_ts=0):
+        from instagram_private_api import ClientError
+
+        self._count('broadcast_comments')
+        if self.origin.has_ended:
+            raise ClientError('Bad Request', 400, error_response='{"message": "media has been deleted"}')
+        count = self.comments_until(min(time.time(), self.origin.end_time))
+        comments = []
+        # newest first
+        for n in range(count - 1, -1, -1):
+            comment = self.comment(n)
+            if comment['created_at_utc'] <= last_comment_ts or len(comments) >= self.page_size:
+                break
+            comments.append(comment)
+        return {'comments': comments, 'comment_count': count, 'status': 'ok'}
+
+
+FAKE_FFMPEG = '''#!%(python)s
+# Stand-in for ffmpeg: writes the -i inputs, concatenated, to the output file (the last arg).
+import sys
+args = sys.argv[1:]
+if '-version' in args:
+    print('fake ffmpeg')
+    sys.exit(0)
+inputs = [args[i + 1] for i, arg in enumerate(args) if arg == '-i']
+with open(args[-1], 'wb') as outfile:
+    for input_file in inputs:
+        with open(input_file, 'rb') as infile:
+            while True:
+                chunk = infile.read(1024 * 1024)
+                if not chunk:
+                    break
+                outfile.write(chunk)
+'''
+
+
+def write_fake_ffmpeg(dir_path):
+    """Write the fake ffmpeg script into dir_path and return its path."""
+    ffmpeg_path = os.path.join(dir_path, 'fake_ffmpeg')
+    with open(ffmpeg_path, 'w') as f:
+        f.write(FAKE_FFMPEG % {'python': sys.executable})
+    os.chmod(ffmpeg_path, 0o755)
+    return ffmpeg_path
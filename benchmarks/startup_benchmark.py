@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""
+Measure the cold start time of the livestream_dl entry point.
+
+Each run is a fresh python process so that nothing is already imported.
+The scenarios are:
+
+- help: ``livestream_dl -h``
+- version: ``livestream_dl -version``, without the network call to check for updates
+- nobroadcast: a download run for a user that is not live, against harness.StubClient
+
+Example:
+    python benchmarks/startup_benchmark.py -r 20
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.join(BENCHMARKS_DIR, '..')
+SCENARIOS = ('help', 'version', 'nobroadcast')
+
+
+def run_scenario(scenario, work_dir):
+    """Run a scenario in this process. Called in the child process."""
+    from livestream_dl import download
+
+    argv = ['livestream_dl', '-ignoreconfig']
+    if scenario == 'help':
+        argv.append('-h')
+    elif scenario == 'version':
+        download.check_for_updates = lambda current_version: ''
+        argv.append('-version')
+    elif scenario == 'nobroadcast':
+        import instagram_private_api
+        from harness import StubClient
+        # without a FakeOrigin, the user is not live
+        instagram_private_api.Client = StubClient
+        argv.extend([
+            '-u', 'benchmark', '-p', 'benchmark',
+            '-settings', os.path.join(work_dir, 'settings.json'),
+            '-outputdir', os.path.join(work_dir, 'downloaded'),
+            '-nousercache', 'notlive'])
+    sys.argv = argv
+    try:
+        download.run()
+    except SystemExit:
+        pass
+
+
+def time_scenario(scenario, work_dir):
+    with open(os.devnull, 'w') as devnull:
+        start = time.time()
+        subprocess.check_call(
+            [sys.executable, os.path.abspath(__file__), '-child', scenario, '-d', work_dir],
+            cwd=work_dir, stdout=devnull, stderr=devnull)
+        return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the livestream_dl startup time.')
+    parser.add_argument('-r', dest='repeat', type=int, default=10, help='Runs per scenario. Default 10.')
+    parser.add_argument('-s', dest='scenarios', nargs='*', choices=SCENARIOS, default=SCENARIOS,
+                        help='Scenarios to run. Default all.')
+    parser.add_argument('-d', dest='tmp_dir', help='Folder to run in.')
+    parser.add_argument('-child', dest='child', choices=SCENARIOS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        sys.path.insert(0, ROOT_DIR)
+        sys.path.insert(0, BENCHMARKS_DIR)
+        run_scenario(args.child, args.tmp_dir)
+        return
+
+    work_dir = tempfile.mkdtemp(prefix='startup_benchmark', dir=args.tmp_dir)
+    try:
+        # python interpreter startup only, for reference
+        timings = []
+        for _ in range(args.repeat):
+            start = time.time()
+            subprocess.check_call([sys.executable, '-c', 'pass'])
+            timings.append(time.time() - start)
+        print('%-12s best %.3fs  avg %.3fs' % ('python', min(timings), sum(timings) / len(timings)))
+
+        for scenario in args.scenarios:
+            timings = [time_scenario(scenario, work_dir) for _ in range(args.repeat)]
+            print('%-12s best %.3fs  avg %.3fs' % (scenario, min(timings), sum(timings) / len(timings)))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,10 +8,15 @@ import logging
 import glob
 import subprocess
 import json
+import tempfile
+import threading
+from contextlib import contextmanager
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 from .utils import Formatter, generate_safe_path
-from .comments import CommentsDownloader
-from moviepy.video.io.VideoFileClip import VideoFileClip
+from .concat import copy_into
+from .mp4 import get_video_resolution
 
 
 def _get_file_index(filename):
@@ -30,34 +35,104 @@ ch.setFormatter(formatter)
 logger.addHandler(ch)
 
 
-def main():
-
-    parser = argparse.ArgumentParser(description='Manually assemble video from download folder.')
-    parser.add_argument('broadcast_json_file')
-    parser.add_argument('-o', dest='output_dir', required=True,
-                        help='Folder containing the downloaded segments.')
-    parser.add_argument('-f', dest='output_filename', required=True,
-                        help='File path for the generated video.')
-    parser.add_argument('-c', dest='comments_json_file',
-                        help='File path to the comments json file.')
-    parser.add_argument('--repair', '-r', dest='repair', action='store_true',
-                        help='Try to repair download segments')
-    parser.add_argument('-cleanup', action='store_true', help='Clean up output_dir and temp files')
-    parser.add_argument('-v', dest='verbose', action='store_true', help='Turn on verbose debug')
-    parser.add_argument('-log', dest='log_file_path', help='Log to file specified.')
-    args = parser.parse_args()
-
-    if args.verbose:
-        logger.setLevel(logging.DEBUG)
-    else:
-        logger.setLevel(logging.INFO)
-
-    if args.log_file_path:
-        file_handler = logging.FileHandler(args.log_file_path)
-        formatter = logging.Formatter('%(asctime)s %(levelname)s: %(message)s')
-        file_handler.setFormatter(formatter)
-        logger.addHandler(file_handler)
+def assemble_source(source):
+    """ Concatenate a source's segments into its video and audio stream files """
+    for stream, i in (('video', 0), ('audio', 1)):
+        with open(source[stream], 'wb') as outfile:
+            for segment_files in source['segments']:
+                copy_into(segment_files[i], outfile)
+                logger.debug(
+                    'Assembling {0!s} stream {1!s} => {2!s}'.format(
+                        stream, os.path.basename(segment_files[i]), os.path.basename(source[stream])))
+
+
+def mux_source(source, output_filename, pipe=False, cleanup=False):
+    """
+    Mux a source's video and audio streams into output_filename with ffmpeg.
+
+    :param source: dict of the source's 'video' and 'audio' stream files and 'segments'
+    :param output_filename: File path for the generated video
+    :param pipe: bool flag to pipe the segments into ffmpeg instead of assembling the stream files
+    :param cleanup: bool flag to remove the stream files after a successful mux
+    :return: ffmpeg exit code
+    """
+    if not pipe:
+        assemble_source(source)
+
+    ffmpeg_binary = os.getenv('FFMPEG_BINARY', 'ffmpeg')
+    with source_inputs(source, pipe=pipe) as inputs:
+        cmd = [
+            ffmpeg_binary, '-loglevel', 'warning', '-y',
+            '-i', inputs['audio'],
+            '-i', inputs['video'],
+            '-c:v', 'copy', '-c:a', 'copy', output_filename]
+        logger.info('Executing: "%s"' % ' '.join(cmd))
+        exit_code = subprocess.call(cmd)
 
+    if exit_code:
+        logger.error('ffmpeg exited with the code: %s (%s)' % (exit_code, output_filename))
+    elif cleanup and not pipe:
+        logger.debug('Cleaning up files... \n%s\n%s' % (source['audio'], source['video']))
+        os.remove(source['audio'])
+        os.remove(source['video'])
+    return exit_code
+
+
+def _write_fifo(fifo_path, segment_files):
+    try:
+        with open(fifo_path, 'wb') as outfile:
+            for segment_file in segment_files:
+                copy_into(segment_file, outfile)
+    except (IOError, OSError) as e:
+        # reader has gone away, usually because ffmpeg has exited
+        logger.debug('Stopped writing to {0!s}: {1!s}'.format(fifo_path, e))
+
+
+@contextmanager
+def source_inputs(source, pipe=False):
+    """
+    Yields a dict with the 'video' and 'audio' paths to be read by ffmpeg.
+
+    If pipe is True, the source's segments are streamed through a pair of
+    named pipes so that no intermediate files are written. Otherwise, the
+    assembled stream files are used.
+    """
+    if not pipe:
+        yield source
+        return
+
+    fifo_dir = tempfile.mkdtemp(prefix='livestream_as')
+    fifos = {}
+    writers = []
+    try:
+        for stream, i in (('video', 0), ('audio', 1)):
+            fifos[stream] = os.path.join(fifo_dir, stream)
+            os.mkfifo(fifos[stream])
+            writer = threading.Thread(
+                target=_write_fifo, args=(fifos[stream], [s[i] for s in source['segments']]))
+            writer.daemon = True
+            writer.start()
+            writers.append((fifos[stream], writer))
+        yield fifos
+    finally:
+        for fifo_path, writer in writers:
+            while writer.is_alive():
+                # Unblock a writer still waiting for a reader
+                try:
+                    os.close(os.open(fifo_path, os.O_RDONLY | os.O_NONBLOCK))
+                except OSError:
+                    pass
+                writer.join(0.1)
+        shutil.rmtree(fifo_dir, ignore_errors=True)
+
+
+def assemble(args):
+    """
+    Assemble a broadcast's downloaded segments into the final video.
+
+    :param args: argparse.Namespace with the livestream_as options
+    :return: list of generated files
+    """
     if not os.path.exists(args.output_dir):
         raise ValueError('Output dir does not exist: %s' % args.output_dir)
     if not os.path.isfile(args.broadcast_json_file):
@@ -93,6 +168,7 @@ def main():
     video_stream_format = 'assembled_source_{0}_{1}_m4a.tmp'
     video_stream = ''
     audio_stream = ''
+    source_segments = {}
 
     pre_v034 = os.path.isfile(os.path.join(args.output_dir, '%s-init.m4v' % stream_id))
 
@@ -121,14 +197,13 @@ def main():
 
         try:
             if pre_v034:
-                # Don't try to probe with moviepy
+                # Don't try to probe the resolution
                 # Just do appending
                 file_mode = 'ab'
             else:
                 if not post_v034:
                     # no segments meta info
-                    vidclip = VideoFileClip(segment)
-                    vid_width, vid_height = vidclip.size
+                    vid_width, vid_height = get_video_resolution(segment)
                     curr_res = '%sx%s' % (vid_width, vid_height)
                     if prev_res and prev_res != curr_res:
                         sources.append({'video': video_stream, 'audio': audio_stream})
@@ -159,47 +234,47 @@ def main():
             # Not a fresh init segment
             file_mode = 'ab'
 
-        with open(video_stream, file_mode) as outfile,\
-                open(segment, 'rb') as readfile:
-            shutil.copyfileobj(readfile, outfile)
-            logger.debug(
-                'Assembling video stream {0!s} => {1!s}'.format(
-                    os.path.basename(segment), os.path.basename(video_stream)))
-
-        with open(audio_stream, file_mode) as outfile,\
-                open(segment.replace('.m4v', '.m4a'), 'rb') as readfile:
-            shutil.copyfileobj(readfile, outfile)
-            logger.debug(
-                'Assembling audio stream {0!s} => {1!s}'.format(
-                    os.path.basename(segment), os.path.basename(audio_stream)))
+        stream_segments = source_segments.setdefault(video_stream, [])
+        if file_mode == 'wb':
+            # Fresh init segment, start the stream over
+            del stream_segments[:]
+        stream_segments.append((segment, segment.replace('.m4v', '.m4a')))
 
     if audio_stream and video_stream:
         sources.append({'video': video_stream, 'audio': audio_stream})
 
-    for n, source in enumerate(sources):
-        dir_name = os.path.dirname(args.output_filename)
-        file_name = os.path.basename(args.output_filename)
-        output_filename = generate_safe_path(file_name, dir_name, is_file=True)
-        ffmpeg_binary = os.getenv('FFMPEG_BINARY', 'ffmpeg')
-        cmd = [
-            ffmpeg_binary, '-loglevel', 'warning', '-y',
-            '-i', source['audio'],
-            '-i', source['video'],
-            '-c:v', 'copy', '-c:a', 'copy', output_filename]
-        logger.info('Executing: "%s"' % ' '.join(cmd))
-        exit_code = subprocess.call(cmd)
-
-        assert not exit_code, 'ffmpeg exited with the code: %s' % exit_code
+    # Reserve the output file names upfront so that they don't depend on the order sources are muxed in
+    output_filenames = []
+    dir_name = os.path.dirname(args.output_filename)
+    file_name = os.path.basename(args.output_filename)
+    for source in sources:
+        source['segments'] = source_segments.get(source['video'], [])
+        output_filenames.append(
+            generate_safe_path(file_name, dir_name, is_file=True, exclude=output_filenames))
+
+    pool = ThreadPool(max(1, min(args.jobs, len(sources))))
+    try:
+        exit_codes = pool.map(
+            lambda job: mux_source(job[0], job[1], pipe=args.pipe, cleanup=args.cleanup),
+            list(zip(sources, output_filenames)))
+    finally:
+        pool.close()
+        pool.join()
+
+    failed_exit_codes = []
+    generated_files = []
+    for output_filename, exit_code in zip(output_filenames, exit_codes):
+        if exit_code:
+            failed_exit_codes.append(exit_code)
+            continue
         assert os.path.isfile(output_filename), '%s not generated.' % output_filename
 
-        if args.cleanup and not exit_code:
-            logger.debug('Cleaning up files... \n%s\n%s' % (source['audio'], source['video']))
-            os.remove(source['audio'])
-            os.remove(source['video'])
-
         logger.info('---------------------------------------------')
         logger.info('Generated file: %s' % output_filename)
         logger.info('---------------------------------------------')
+        generated_files.append(output_filename)
+
+    assert not failed_exit_codes, 'ffmpeg exited with the code: %s' % ', '.join(map(str, failed_exit_codes))
 
     if args.comments_json_file:
         # convert json to srt
@@ -209,10 +284,9 @@ def main():
         filename_segments[-1] = 'srt'
         srt_file = '.'.join(filename_segments)
 
-        with open(args.comments_json_file) as cj:
-            comments_info = json.load(cj)
-
-        comments = comments_info.get('comments', [])
+        # imports the api client, so only when needed
+        from .comments import CommentsDownloader
+        comments_info, comments = CommentsDownloader.load(args.comments_json_file)
         CommentsDownloader.generate_srt(
             comments, download_start_time, srt_file,
             comments_delay=comments_info.get('initial_buffered_duration', 10.0))
@@ -220,6 +294,140 @@ def main():
         assert os.path.isfile(srt_file), '%s not generated.' % srt_file
         logger.info('Comments written to: %s' % srt_file)
 
+    return generated_files
+
+
+def find_batch_jobs(args):
+    """
+    Find the broadcasts in the archive folder that can be assembled, i.e. the meta json files
+    that have a matching _downloads folder and have not already been assembled.
+
+    :param args: argparse.Namespace with the livestream_as options
+    :return: list of argparse.Namespace, one for each broadcast
+    """
+    jobs = []
+    for broadcast_json_file in sorted(glob.glob(os.path.join(args.batch_dir, '*.json'))):
+        filename_prefix = broadcast_json_file[:-len('.json')]
+        output_dir = '%s_downloads' % filename_prefix
+        if filename_prefix.endswith('_comments') or not os.path.isdir(output_dir):
+            continue
+        output_filename = '%s.mp4' % filename_prefix
+        if os.path.isfile(output_filename) or os.path.isfile('%s-1.mp4' % filename_prefix):
+            logger.debug('Already assembled: %s' % broadcast_json_file)
+            continue
+        try:
+            with open(broadcast_json_file) as info_file:
+                broadcast_info = json.load(info_file)
+        except ValueError:
+            logger.warning('Invalid broadcast json file: %s' % broadcast_json_file)
+            continue
+        if broadcast_info.get('broadcast_status', '') == 'post_live' or 'id' not in broadcast_info:
+            continue
+
+        comments_json_file = None
+        for ext in ('json', 'jsonl'):
+            if os.path.isfile('%s_comments.%s' % (filename_prefix, ext)):
+                comments_json_file = '%s_comments.%s' % (filename_prefix, ext)
+                break
+
+        job = argparse.Namespace(**vars(args))
+        job.broadcast_json_file = broadcast_json_file
+        job.output_dir = output_dir
+        job.output_filename = output_filename
+        job.comments_json_file = comments_json_file
+        job.jobs = 1
+        jobs.append(job)
+    return jobs
+
+
+def _assemble_batch_job(job):
+    try:
+        return job.broadcast_json_file, assemble(job), None
+    except Exception as e:
+        return job.broadcast_json_file, [], str(e) or repr(e)
+
+
+def assemble_batch(args):
+    """
+    Assemble every broadcast in the archive folder with a pool of args.jobs processes.
+
+    :param args: argparse.Namespace with the livestream_as options
+    :return: number of broadcasts that failed to assemble
+    """
+    jobs = find_batch_jobs(args)
+    if not jobs:
+        logger.info('Nothing to assemble in %s' % args.batch_dir)
+        return 0
+
+    logger.info('Assembling %d broadcast(s) with %d process(es)...' % (len(jobs), max(1, args.jobs)))
+    failed_count = 0
+    pool = multiprocessing.Pool(max(1, args.jobs))
+    try:
+        results = pool.imap_unordered(_assemble_batch_job, jobs)
+        for n, (broadcast_json_file, generated_files, error) in enumerate(results, start=1):
+            if error:
+                failed_count += 1
+                logger.error('[%d/%d] Failed %s: %s' % (n, len(jobs), broadcast_json_file, error))
+            else:
+                logger.info('[%d/%d] Assembled %s' % (n, len(jobs), ', '.join(generated_files)))
+    finally:
+        pool.close()
+        pool.join()
+
+    logger.info('%d of %d broadcast(s) assembled.' % (len(jobs) - failed_count, len(jobs)))
+    return failed_count
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Manually assemble video from download folder.')
+    parser.add_argument('broadcast_json_file', nargs='?')
+    parser.add_argument('-o', dest='output_dir',
+                        help='Folder containing the downloaded segments.')
+    parser.add_argument('-f', dest='output_filename',
+                        help='File path for the generated video.')
+    parser.add_argument('-batch', dest='batch_dir',
+                        help='Assemble every broadcast in the download folder specified. '
+                             'Broadcasts that have already been assembled are skipped.')
+    parser.add_argument('-c', dest='comments_json_file',
+                        help='File path to the comments json or .jsonl journal file.')
+    parser.add_argument('--repair', '-r', dest='repair', action='store_true',
+                        help='Try to repair download segments')
+    parser.add_argument('-cleanup', action='store_true', help='Clean up output_dir and temp files')
+    parser.add_argument('-pipe', action='store_true',
+                        help='Pipe the segments straight into ffmpeg without writing temp files')
+    parser.add_argument('-j', dest='jobs', type=int, default=1,
+                        help='Number of sources to mux concurrently when the resolution changes, '
+                             'or number of broadcasts to assemble concurrently in batch mode. Default 1.')
+    parser.add_argument('-v', dest='verbose', action='store_true', help='Turn on verbose debug')
+    parser.add_argument('-log', dest='log_file_path', help='Log to file specified.')
+    args = parser.parse_args()
+
+    if not args.batch_dir and not (args.broadcast_json_file and args.output_dir and args.output_filename):
+        parser.error('broadcast_json_file, -o and -f are required unless -batch is used')
+
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
+    else:
+        logger.setLevel(logging.INFO)
+
+    if args.log_file_path:
+        file_handler = logging.FileHandler(args.log_file_path)
+        formatter = logging.Formatter('%(asctime)s %(levelname)s: %(message)s')
+        file_handler.setFormatter(formatter)
+        logger.addHandler(file_handler)
+
+    if args.pipe and not hasattr(os, 'mkfifo'):
+        logger.warning('Piping is not supported on this platform. Temp files will be used instead.')
+        args.pipe = False
+
+    if args.batch_dir:
+        if not os.path.isdir(args.batch_dir):
+            raise ValueError('Batch folder does not exist: %s' % args.batch_dir)
+        exit(1 if assemble_batch(args) else 0)
+
+    assemble(args)
+
 
 if __name__ == '__main__':
     main()
@@ -1,6 +1,9 @@
+import os
 import time
 import json
 import codecs
+import threading
+from multiprocessing.pool import ThreadPool
 from socket import timeout, error as SocketError
 from ssl import SSLError
 try:
@@ -14,108 +17,322 @@ except ImportError:
 
 from instagram_private_api import ClientError
 
+from .filters import CommentFilter
+
+try:
+    # py2
+    string_types = basestring
+except NameError:
+    # py3
+    string_types = str
+
+
+class AdaptivePoller(object):
+    """
+    Picks the delay before the next comments poll.
+
+    The delay is shortened when a poll returns a (nearly) full page since comments
+    may have been missed, and lengthened when polls come back empty. Otherwise,
+    the delay is set from the recent comments-per-second rate so that each poll
+    returns about half a page. Errors back off exponentially.
+    """
+
+    DEFAULT_DELAY = 4.0
+    MIN_DELAY = 1.0
+    MAX_DELAY = 15.0
+    MAX_BACKOFF_DELAY = 120.0
+    FULL_PAGE_SIZE = 10     # smallest batch that can be considered a full page
+    FULL_PAGE_RATIO = 0.8
+    RATE_SMOOTHING = 0.5
+
+    def __init__(self, min_delay=None, max_delay=None):
+        self.min_delay = min_delay or self.MIN_DELAY
+        self.max_delay = max_delay or self.MAX_DELAY
+        self.delay = self.DEFAULT_DELAY
+        self.page_size = 0
+        self.rate = 0.0
+        self.errors = 0
+        self.last_poll = None
+
+    def record(self, count):
+        """Record the number of comments returned by a successful poll and get the next delay."""
+        now = time.time()
+        if self.last_poll and now > self.last_poll:
+            rate = count / (now - self.last_poll)
+            self.rate = self.RATE_SMOOTHING * rate + (1 - self.RATE_SMOOTHING) * self.rate
+        self.last_poll = now
+        self.errors = 0
+        self.page_size = max(self.page_size, count)
+
+        if count >= self.FULL_PAGE_SIZE and count >= self.FULL_PAGE_RATIO * self.page_size:
+            # page is full, poll sooner
+            delay = self.delay / 2
+        elif not count:
+            delay = self.delay * 1.5
+        elif self.rate:
+            # aim for half a page per poll
+            delay = max(self.page_size, self.FULL_PAGE_SIZE) / 2.0 / self.rate
+        else:
+            delay = self.delay
+        self.delay = min(self.max_delay, max(self.min_delay, delay))
+        return self.delay
+
+    def backoff(self):
+        """Record a failed poll and get the next delay."""
+        self.errors += 1
+        self.delay = min(self.MAX_BACKOFF_DELAY, self.DEFAULT_DELAY * (2 ** self.errors))
+        return self.delay
+
 
 class CommentsDownloader(object):
 
+    # consecutive errors before replay comments collection gives up
+    MAX_REPLAY_ERRORS = 5
+    # replay comments are fetched concurrently in windows of this many seconds
+    REPLAY_WINDOW = 300
+    # max concurrent replay comments requests, to stay within rate limits
+    REPLAY_WORKERS = 3
+
     def __init__(self, api, broadcast, destination_file, user_config, logger):
         self.api = api
         self.broadcast = broadcast
         self.destination_file = destination_file
+        self.journal_file = self.journal_path(destination_file)
         self.user_config = user_config
         self.logger = logger
+        self.comment_filter = CommentFilter.from_config(user_config)
         self.comments = []
-        self.aborted = False
+        self.stop_event = threading.Event()
+        self.poller = AdaptivePoller()
+        # duration of the last live comments api call
+        self.poll_latency = None
+        self._journaled_broadcast = None
+
+    @property
+    def aborted(self):
+        return self.stop_event.is_set()
+
+    def abort(self):
+        """Stop collecting comments. Any wait between polls is cut short."""
+        self.stop_event.set()
+
+    def wait(self, delay):
+        """Sleep between polls unless aborted. Returns True if aborted."""
+        return self.stop_event.wait(delay)
+
+    @staticmethod
+    def journal_path(destination_file):
+        """File path of the line-delimited journal for a comments json file"""
+        return os.path.splitext(destination_file)[0] + '.jsonl'
+
+    def _broadcast_info(self):
+        broadcast = self.broadcast.copy()
+        broadcast.pop('segments', None)     # save space
+        broadcast.pop('perf', None)         # save space, it has an entry per segment too
+        broadcast.pop('comments', None)
+        return broadcast
+
+    def append_journal(self, comments):
+        """
+        Append newly collected comments to the journal.
+
+        Each line is a json object with either a ``broadcast`` key for the broadcast
+        info or a ``comments`` key for a batch of comments. The broadcast info is
+        written again only if it has changed since it was last journaled.
+        """
+        records = []
+        broadcast = self._broadcast_info()
+        if broadcast != self._journaled_broadcast:
+            records.append({'broadcast': broadcast})
+            self._journaled_broadcast = broadcast
+        if comments:
+            records.append({'comments': comments})
+        if not records:
+            return
+        with open(self.journal_file, 'a') as outfile:
+            outfile.write(''.join([json.dumps(r) + '\n' for r in records]))
+
+    @staticmethod
+    def load(comments_file):
+        """
+        Load the broadcast info and comments from either the final comments json file
+        or the line-delimited journal.
+
+        :param comments_file: path to a .json or .jsonl comments file
+        :return: tuple of (broadcast info dict, list of comments)
+        """
+        if not comments_file.endswith('.jsonl'):
+            with open(comments_file) as cj:
+                comments_info = json.load(cj)
+            return comments_info, comments_info.get('comments', [])
+
+        broadcast = {}
+        comments = []
+        with open(comments_file) as cj:
+            for line in cj:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # last line may be incomplete if the process was killed while writing
+                    continue
+                if 'broadcast' in record:
+                    broadcast = record['broadcast']
+                comments.extend(record.get('comments', []))
+        broadcast['comments'] = comments
+        return broadcast, comments
 
     def get_live(self, first_comment_created_at=0):
         comments_collected = self.comments
-        commenter_ids = self.user_config.commenters or []
 
         before_count = len(comments_collected)
+        delay = self.poller.delay
+        poll_start = time.time()
         try:
             comments_res = self.api.broadcast_comments(
                 self.broadcast['id'], last_comment_ts=first_comment_created_at)
+            self.poll_latency = time.time() - poll_start
             comments = comments_res.get('comments', [])
+            delay = self.poller.record(len(comments))
             first_comment_created_at = (
                 comments[0]['created_at_utc'] if comments else int(time.time() - 5))
-            # save comment if it's in list of commenter IDs or if user is verified
-            comments_collected.extend(
-                list(filter(
-                    lambda x: (str(x['user_id']) in commenter_ids or
-                               x['user']['username'] in commenter_ids or
-                               x['user']['is_verified']),
-                    comments)))
+            # save comment if it matches the filter rules, e.g. in list of commenter IDs or if user is verified
+            comments_collected.extend(self.comment_filter.apply_live(comments))
             after_count = len(comments_collected)
             if after_count > before_count:
-                # save intermediately to avoid losing comments due to unexpected errors
-                broadcast = self.broadcast.copy()
-                broadcast.pop('segments', None)     # save space
-                broadcast['comments'] = comments_collected
-                with open(self.destination_file, 'w') as outfile:
-                    json.dump(broadcast, outfile, indent=2)
+                # journal intermediately to avoid losing comments due to unexpected errors
+                self.append_journal(comments_collected[before_count:])
             self.comments = comments_collected
 
         except (SSLError, timeout, URLError, HTTPException, SocketError) as e:
             # Probably transient network error, ignore and continue
             self.logger.warning('Comment collection error: %s' % e)
+            delay = self.poller.backoff()
         except ClientError as e:
-            if e.code == 500:
+            if e.code in (429, 500):
                 self.logger.warning('Comment collection ClientError: %d %s' % (e.code, e.error_response))
+                delay = self.poller.backoff()
             elif e.code == 400 and not e.msg:   # 400 error fail but no error message
                 self.logger.warning('Comment collection ClientError: %d %s' % (e.code, e.error_response))
+                delay = self.poller.backoff()
             else:
                 raise e
         finally:
-            time.sleep(4)
+            self.wait(delay)
         return first_comment_created_at
 
-    def get_replay(self):
-        comments_collected = []
-        starting_offset = 0
+    def _get_replay_window(self, window):
+        """
+        Page through the replay comments in an offset window.
+
+        :param window: tuple of (start offset, end offset). The end offset is None for the last window.
+        :return: list of unfiltered replay comments with offsets in the window
+        """
+        window_start, window_end = window
+        starting_offset = window_start
         encoding_tag = self.broadcast['encoding_tag']
-        commenter_ids = self.user_config.commenters or []
-        while True:
-            comments_res = self.api.replay_broadcast_comments(
-                self.broadcast['id'], starting_offset=starting_offset, encoding_tag=encoding_tag)
+        duration = self.broadcast.get('duration')
+        comments_collected = []
+        # replay comments are already available so there's no need to wait for them
+        poller = AdaptivePoller(min_delay=2.0, max_delay=AdaptivePoller.DEFAULT_DELAY)
+        while not self.aborted:
+            try:
+                comments_res = self.api.replay_broadcast_comments(
+                    self.broadcast['id'], starting_offset=starting_offset, encoding_tag=encoding_tag)
+            except (SSLError, timeout, URLError, HTTPException, SocketError, ClientError) as e:
+                if (isinstance(e, ClientError) and e.code not in (429, 500)) or \
+                        poller.errors >= self.MAX_REPLAY_ERRORS:
+                    raise
+                self.logger.warning('Comment collection error: %s' % e)
+                self.wait(poller.backoff())
+                continue
             starting_offset = comments_res.get('ending_offset', 0)
             comments = comments_res.get('comments', [])
-            comments_collected.extend(
-                list(filter(
-                    lambda x: (str(x['comment']['user']['pk']) in commenter_ids or
-                               x['comment']['user']['username'] in commenter_ids or
-                               x['comment']['user']['is_verified']),
-                    comments)))
-            if self.broadcast['duration'] and starting_offset and self.broadcast['duration'] < starting_offset:
+            delay = poller.record(len(comments))
+            comments_collected.extend([
+                c for c in comments
+                if window_end is None or c.get('offset', window_start) < window_end])
+            if duration and starting_offset and duration < starting_offset:
                 # offset is past video duration
                 break
-            elif not comments_res.get('comments') or not starting_offset:
+            elif window_end is not None and starting_offset and starting_offset >= window_end:
+                # offset is past the window, the next worker takes over
+                break
+            elif not comments or not starting_offset:
                 break
-            time.sleep(4)
+            self.wait(delay)
+        return comments_collected
+
+    def get_replay(self):
+        duration = int(self.broadcast.get('duration') or 0)
+        if duration > self.REPLAY_WINDOW:
+            windows = [
+                (window_start, window_start + self.REPLAY_WINDOW)
+                for window_start in range(0, duration, self.REPLAY_WINDOW)]
+            windows[-1] = (windows[-1][0], None)
+        else:
+            windows = [(0, None)]
+
+        if len(windows) > 1:
+            self.logger.debug('Collecting replay comments in %d windows' % len(windows))
+            pool = ThreadPool(min(self.REPLAY_WORKERS, len(windows)))
+            try:
+                results = pool.map(self._get_replay_window, windows)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [self._get_replay_window(windows[0])]
+
+        # windows may overlap where a page crosses the window end
+        comments_collected = []
+        seen = set()
+        for comments in results:
+            for c in comments:
+                comment_id = c['comment'].get('pk')
+                if comment_id is not None:
+                    if comment_id in seen:
+                        continue
+                    seen.add(comment_id)
+                comments_collected.append(c)
+        comments_collected.sort(key=lambda c: c.get('offset', 0))
+        comments_collected = self.comment_filter.apply_replay(comments_collected)
 
         self.logger.info('%d comments collected' % len(comments_collected))
         if comments_collected:
-            self.broadcast['comments'] = comments_collected
-            self.broadcast['initial_buffered_duration'] = 0
+            # don't modify the broadcast info since it may be in use by the video download
+            broadcast = self._broadcast_info()
+            broadcast['comments'] = comments_collected
+            broadcast['initial_buffered_duration'] = 0
             with open(self.destination_file, 'w') as outfile:
-                json.dump(self.broadcast, outfile, indent=2)
+                json.dump(broadcast, outfile, indent=2)
         self.comments = comments_collected
 
     def save(self):
-        broadcast = self.broadcast.copy()
-        broadcast.pop('segments', None)     # save space
+        """Write the final comments json file and remove the journal."""
+        broadcast = self._broadcast_info()
         broadcast['comments'] = self.comments
         with open(self.destination_file, 'w') as outfile:
             json.dump(broadcast, outfile, indent=2)
+        if os.path.isfile(self.journal_file):
+            os.remove(self.journal_file)
 
     @staticmethod
     def generate_srt(comments, download_start_time, srt_file, comments_delay=10.0):
         """
         Generate a valid srt file from the list of comments.
+        comments can also be the path to a comments json or journal file.
 
         comments_delay is to compensate for the 10s video buffer available when
         we first begin downloading (segment timeline has 10 segments). This buffer
         is variable because the duration of the segment varies, so 10s is just
         an average.
         """
+        if isinstance(comments, string_types):
+            _, comments = CommentsDownloader.load(comments)
+
         subtitles_timeline = {}
         for i, c in enumerate(comments):
             # grouped closely timed comments into 2s blocks so that we can give it enough onscreen time
@@ -0,0 +1,106 @@
+"""
+Concatenates files using in-kernel copies where available.
+
+``os.copy_file_range`` (Linux, py3.8+) and ``os.sendfile`` (py3.3+) copy between
+file descriptors without passing the data through user space buffers.
+Everything else falls back to a buffered ``shutil.copyfileobj``.
+"""
+import os
+import stat
+import shutil
+import errno
+
+_UNSUPPORTED_ERRNOS = (
+    errno.EINVAL, errno.ENOSYS, errno.EXDEV, errno.EBADF,
+    getattr(errno, 'ENOTSUP', errno.EINVAL), getattr(errno, 'EOPNOTSUPP', errno.EINVAL))
+
+# (copy method, output fd kind) combinations that have failed as unsupported
+_unsupported = set()
+
+
+def _copy_file_range(in_fd, out_fd, count):
+    return os.copy_file_range(in_fd, out_fd, count)
+
+
+def _sendfile(in_fd, out_fd, count):
+    return os.sendfile(out_fd, in_fd, None, count)
+
+
+KERNEL_COPY_METHODS = [
+    (name, func) for name, func in (
+        ('copy_file_range', _copy_file_range),
+        ('sendfile', _sendfile))
+    if hasattr(os, name)]
+
+
+def _fd_kind(fd):
+    # copy_file_range and sendfile support depends on the type of output, and whether it's in append mode
+    is_append = False
+    try:
+        import fcntl
+        is_append = bool(fcntl.fcntl(fd, fcntl.F_GETFL) & os.O_APPEND)
+    except ImportError:
+        pass
+    return stat.S_IFMT(os.fstat(fd).st_mode), is_append
+
+
+def _kernel_copy(copy_func, in_fd, out_fd, size):
+    remaining = size
+    while remaining > 0:
+        copied = copy_func(in_fd, out_fd, remaining)
+        if not copied:
+            # source was truncated
+            break
+        remaining -= copied
+    return size - remaining
+
+
+def copy_into(src_file, outfile, method=None):
+    """
+    Append the contents of the file at src_file to the open binary file object outfile.
+
+    :param src_file: path to the file to be copied
+    :param outfile: binary file object opened for writing
+    :param method: force a copy method: 'copy_file_range', 'sendfile' or 'buffered'.
+        By default, the fastest method available is used.
+    :return: name of the copy method used
+    """
+    with open(src_file, 'rb') as readfile:
+        if method != 'buffered' and KERNEL_COPY_METHODS:
+            # flush pending buffered writes so that the kernel copy goes after them
+            outfile.flush()
+            in_fd, out_fd = readfile.fileno(), outfile.fileno()
+            size = os.fstat(in_fd).st_size
+            out_kind = _fd_kind(out_fd)
+            for name, func in KERNEL_COPY_METHODS:
+                if (method and name != method) or (name, out_kind) in _unsupported:
+                    continue
+                try:
+                    copied = _kernel_copy(func, in_fd, out_fd, size)
+                except OSError as e:
+                    if method or e.errno not in _UNSUPPORTED_ERRNOS:
+                        raise
+                    # eg. fs/kernel does not support it, don't try again for this kind of output
+                    _unsupported.add((name, out_kind))
+                    readfile.seek(0)
+                    continue
+                if copied < size:
+                    readfile.seek(copied)
+                    shutil.copyfileobj(readfile, outfile)
+                return name
+
+        shutil.copyfileobj(readfile, outfile)
+        return 'buffered'
+
+
+def concat_files(src_files, dest_file, method=None):
+    """
+    Concatenate src_files into a new dest_file.
+
+    :param src_files: list of file paths
+    :param dest_file: output file path
+    :param method: see ``copy_into()``
+    """
+    with open(dest_file, 'wb') as outfile:
+        for src_file in src_files:
+            copy_into(src_file, outfile, method=method)
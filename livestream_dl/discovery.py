@@ -0,0 +1,41 @@
+def is_replay(broadcast):
+    return broadcast['broadcast_status'] == 'post_live' or 'dash_playback_url' not in broadcast
+
+
+def get_broadcasts(res, noreplay=False):
+    """Extract the downloadable broadcasts from a user story feed response."""
+    if res.get('broadcast'):
+        return [res['broadcast']]
+    if noreplay:
+        return []
+    return res.get('post_live_item', {}).get('broadcasts') or []
+
+
+def discover_broadcasts(api, user_ids):
+    """
+    Find the current and replay broadcasts for many users with a single api call.
+
+    Uses the reels tray, which lists the live broadcasts and post live items of
+    every account followed by the logged in user. Users that are not followed
+    will never be found this way.
+
+    :param api: Client instance
+    :param user_ids: list of numeric IG user IDs
+    :return: dict of user ID to a user story feed-like response, i.e.
+        ``{'broadcast': {...}, 'post_live_item': {'broadcasts': [...]}}``.
+        Users without any broadcast are mapped to an empty dict.
+    """
+    feeds = dict((str(user_id), {}) for user_id in user_ids)
+    res = api.reels_tray()
+
+    for broadcast in res.get('broadcasts') or []:
+        owner_id = str(broadcast.get('broadcast_owner', {}).get('pk', ''))
+        if owner_id in feeds:
+            feeds[owner_id]['broadcast'] = broadcast
+
+    for post_live_item in (res.get('post_live') or {}).get('post_live_items') or []:
+        owner_id = str(post_live_item.get('user', {}).get('pk', ''))
+        if owner_id in feeds:
+            feeds[owner_id]['post_live_item'] = post_live_item
+
+    return feeds
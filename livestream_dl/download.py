@@ -6,48 +6,41 @@ import os
 import time
 import datetime
 import argparse
-import getpass
 import json
 import threading
-import webbrowser
 import shutil
-import subprocess
-from socket import timeout, error as SocketError
-from ssl import SSLError
 from string import Formatter as StringFormatter
-import glob
 try:
     # py2
-    from urllib2 import URLError
-    from httplib import HTTPException
     from ConfigParser import SafeConfigParser
 except ImportError:
     # py3
-    from urllib.error import URLError
-    from http.client import HTTPException
     from configparser import SafeConfigParser
 
-from instagram_private_api import (
-    Client, ClientError, ClientCookieExpiredError, ClientLoginRequiredError
-)
-from instagram_private_api_extensions.live import (
-    Downloader, logger as dash_logger
-)
-from instagram_private_api_extensions.replay import (
-    Downloader as ReplayDownloader, logger as replay_dash_logger
-)
-
+# The api client and the downloaders (requests) are slow to import, so they are
+# only imported in the code paths that need them to keep the startup fast.
 from .utils import (
-    Formatter, UserConfig, check_for_updates,
-    to_json, from_json, generate_safe_path
+    Formatter, JsonFormatter, UserConfig, PhaseTimer, check_for_updates,
+    to_json, from_json, generate_safe_path, network_errors, start_log_listener
 )
-from .comments import CommentsDownloader
+from .filters import CommentFilter
+from .watch import Watcher, read_watch_list
+from .discovery import get_broadcasts, is_replay
+from .index import DownloadIndex
+from .usercache import UserIdCache
 
 
 __version__ = '0.3.8'
 
 USERNAME_ENV_KEY = 'IG_LOGIN_USERNAME'
+
 PASSWORD_ENV_KEY = 'IG_LOGIN_PASSWORD'
+# same defaults as instagram_private_api_extensions.live.Downloader,
+# which is not imported just to show them in the help
+MPD_DOWNLOAD_TIMEOUT = 2
+DOWNLOAD_TIMEOUT = 15
+# default max number of replays downloaded at the same time
+REPLAY_WORKERS = 2
 
 
 logger = logging.getLogger(__file__)
@@ -56,14 +49,24 @@ ch.setLevel(logging.DEBUG)
 formatter = Formatter()
 ch.setFormatter(formatter)
 logger.addHandler(ch)
-dash_logger.addHandler(ch)
-replay_dash_logger.addHandler(ch)
 
 api_logger = logging.getLogger('instagram_private_api')
 api_logger.addHandler(ch)
 
 rule_line = '-' * 80
 
+# don't use default device profile
+custom_device = {
+    'phone_manufacturer': 'samsung',
+    'phone_model': 'hero2lte',
+    'phone_device': 'SM-G935F',
+    'android_release': '6.0.1',
+    'android_version': 23,
+    'phone_dpi': '640dpi',
+    'phone_resolution': '1440x2560',
+    'phone_chipset': 'samsungexynos8890'
+}
+
 
 def onlogin_callback(api, new_settings_file):
     # saved auth cookies on login
@@ -73,7 +76,30 @@ def onlogin_callback(api, new_settings_file):
         logger.debug('Saved settings: %s' % new_settings_file)
 
 
+_extension_loggers_lock = threading.Lock()
+_extension_loggers_ready = False
+
+
+def init_extension_loggers():
+    """
+    Apply the logger's level and handlers to the instagram_private_api_extensions
+    loggers. Done on first use since the extensions are imported only when needed.
+    """
+    global _extension_loggers_ready
+    with _extension_loggers_lock:
+        if _extension_loggers_ready:
+            return
+        from instagram_private_api_extensions.live import logger as dash_logger
+        from instagram_private_api_extensions.replay import logger as replay_dash_logger
+        for dl_logger in (dash_logger, replay_dash_logger):
+            dl_logger.setLevel(logger.level)
+            for handler in logger.handlers:
+                dl_logger.addHandler(handler)
+        _extension_loggers_ready = True
+
+
 def check_ffmpeg(binary_path):
+    import subprocess
     ffmpeg_binary = binary_path or os.getenv('FFMPEG_BINARY', 'ffmpeg')
     cmd = [
         ffmpeg_binary, '-version']
@@ -82,8 +108,60 @@ def check_ffmpeg(binary_path):
     logger.debug('Exit code: %s' % exit_code)
 
 
-def is_replay(broadcast):
-    return broadcast['broadcast_status'] == 'post_live' or 'dash_playback_url' not in broadcast
+def login(user_username, user_password, settings_file_path):
+    """Login afresh and save the auth settings."""
+    from instagram_private_api import Client
+    return Client(
+        user_username, user_password,
+        on_login=lambda x: onlogin_callback(x, settings_file_path),
+        **custom_device)
+
+
+def init_client(user_username, user_password, settings_file_path):
+    """Init the api client, reusing the cached auth settings if available."""
+    from instagram_private_api import (
+        Client, ClientError, ClientCookieExpiredError, ClientLoginRequiredError
+    )
+    api = None
+    try:
+        if not os.path.isfile(settings_file_path):
+            # login afresh
+            api = login(user_username, user_password, settings_file_path)
+        else:
+            # reuse cached auth
+            with open(settings_file_path) as file_data:
+                cached_settings = json.load(file_data, object_hook=from_json)
+
+            # always use latest app ver, sig key, etc from lib
+            for key in ('app_version', 'signature_key', 'key_version', 'ig_capabilities'):
+                cached_settings.pop(key, None)
+            api = Client(
+                user_username, user_password,
+                settings=cached_settings,
+                **custom_device)
+
+    except (ClientCookieExpiredError, ClientLoginRequiredError) as e:
+        logger.warning('ClientCookieExpiredError/ClientLoginRequiredError: %s' % e)
+        api = login(user_username, user_password, settings_file_path)
+
+    except ClientError as e:
+        logger.error('ClientError %s (Code: %d, Response: %s)' % (e.msg, e.code, e.error_response))
+        exit(9)
+
+    except Exception as e:
+        logger.error('Unexpected Exception: %s' % e)
+        exit(99)
+
+    if not api:
+        logger.error('Unable to init api client')
+        exit(99)
+
+    if user_username != api.authenticated_user_name:
+        logger.warning(
+            'Authenticated username mismatch: %s vs %s'
+            % (user_username, api.authenticated_user_name))
+
+    return api
 
 
 def generate_filename_prefix(broadcast, userconfig):
@@ -115,8 +193,476 @@ def generate_filename_prefix(broadcast, userconfig):
     return filename_prefix
 
 
+def live_perf(dl, timer=None, heartbeat_times=None, stitch_time=None):
+    """
+    Performance report of a live download, saved into the broadcast meta file.
+
+    :param dl: LiveDownloader instance
+    :param timer: optional PhaseTimer for the startup phases
+    :param heartbeat_times: list of the heartbeat api call durations
+    :param stitch_time: duration of the stitch including the ffmpeg mux
+    :return: dict
+    """
+    start_time = timer.start_time if timer else dl.run_start_time
+    latencies = [seg['latency'] for seg in dl.segment_perf.values()]
+    heartbeat_times = heartbeat_times or []
+    perf = {
+        'phases': timer.as_dict() if timer else {},
+        'startup': round(timer.elapsed, 3) if timer else None,
+        'time_to_first_segment': (
+            round(dl.first_segment_time - start_time, 3) if dl.first_segment_time and start_time else None),
+        'segments': dl.segment_perf,
+        'segment_latency': {
+            'avg': round(sum(latencies) / len(latencies), 3) if latencies else None,
+            'max': max(latencies) if latencies else None,
+        },
+        'heartbeats': {
+            'count': len(heartbeat_times),
+            'avg': round(sum(heartbeat_times) / len(heartbeat_times), 3) if heartbeat_times else None,
+            'max': round(max(heartbeat_times), 3) if heartbeat_times else None,
+        },
+        'stitch': round(stitch_time, 3) if stitch_time is not None else None,
+        'mux': round(dl.mux_time, 3),
+        'requests': dl.session.stats.totals() if hasattr(dl.session, 'stats') else {},
+    }
+    return perf
+
+
+def perf_summary(perf):
+    """One line summary of a live_perf() report."""
+
+    def seconds(value):
+        return '%.2fs' % value if value is not None else '-'
+
+    parts = []
+    if perf['startup'] is not None:
+        parts.append('startup %s' % seconds(perf['startup']))
+    parts.append('first segment %s' % seconds(perf['time_to_first_segment']))
+    parts.append('%d segment files, latency avg %s max %s' % (
+        len(perf['segments']), seconds(perf['segment_latency']['avg']), seconds(perf['segment_latency']['max'])))
+    parts.append('%d heartbeats, avg %s max %s' % (
+        perf['heartbeats']['count'], seconds(perf['heartbeats']['avg']), seconds(perf['heartbeats']['max'])))
+    parts.append('stitch %s (mux %s)' % (seconds(perf['stitch']), seconds(perf['mux'])))
+    return ', '.join(parts)
+
+
+def download_broadcast(api, broadcast, userconfig, downloaders=None, index=None, timer=None, metrics=None):
+    """
+    Download a live or replay broadcast.
+
+    :param api: Client instance
+    :param broadcast: broadcast info from the user's story feed
+    :param userconfig: UserConfig instance
+    :param downloaders: optional dict to which the live or replay Downloader is registered
+        by broadcast ID so that the caller can stop it
+    :param index: optional DownloadIndex to check and record completed downloads
+    :param timer: optional PhaseTimer for the startup phases, logged when the
+        first live manifest is downloaded
+    :param metrics: optional MetricsServer to report the live download to
+    """
+    from instagram_private_api import ClientError
+    from .comments import CommentsDownloader
+    from .live import LiveDownloader
+    from .replay import ReplayDownloader
+    from .net import create_session
+    init_extension_loggers()
+    # tag the log records with the broadcast, e.g. for -logformat json
+    broadcast_logger = logging.LoggerAdapter(logger, {'broadcast_id': broadcast['id']})
+
+    if broadcast['broadcast_status'] not in ['active', 'post_live']:
+        # Usually because it's interrupted
+        broadcast_logger.warning('Broadcast status is currently: %s' % broadcast['broadcast_status'])
+
+    # check if output dir exists, create if otherwise
+    if not os.path.exists(userconfig.outputdir):
+        os.makedirs(userconfig.outputdir)
+
+    is_replay_broadcast = is_replay(broadcast)
+
+    download_start_time = int(time.time())
+    filename_prefix = generate_filename_prefix(broadcast, userconfig)
+
+    # dash_abr_playback_url has the higher def stream
+    mpd_url = (broadcast.get('dash_manifest')
+               or broadcast.get('dash_abr_playback_url')
+               or broadcast['dash_playback_url'])
+
+    # Print broadcast info to console
+    broadcast_logger.info(rule_line)
+    started_mins, started_secs = divmod((int(time.time()) - broadcast['published_time']), 60)
+    broadcast_logger.info('Broadcast by: %s \t(%s)\tType: %s' % (
+        broadcast['broadcast_owner']['username'],
+        broadcast['id'],
+        'Live' if not is_replay_broadcast else 'Replay')
+    )
+    if not is_replay_broadcast:
+        started_label = '%dm' % started_mins
+        if started_secs:
+            started_label += ' %ds' % started_secs
+        broadcast_logger.info(
+            'Viewers: %d \t\tStarted: %s ago' % (
+                broadcast.get('viewer_count', 0),
+                started_label)
+        )
+        broadcast_logger.info('Dash URL: %s' % mpd_url)
+        broadcast_logger.info(rule_line)
+
+    # Record the delay = duration of the stream that has been missed
+    broadcast['delay'] = ((download_start_time - broadcast['published_time'])
+                          if not is_replay_broadcast else 0)
+
+    # folder path for downloaded segments
+    mpd_output_dir = generate_safe_path(
+        '%s_downloads' % filename_prefix, userconfig.outputdir, is_file=False)
+
+    # file path to save the stream's info
+    meta_json_file = generate_safe_path('%s.json' % filename_prefix, userconfig.outputdir)
+
+    # file path to save collected comments
+    # also free for its .jsonl journal, which may be left by an earlier capture that did not finish
+    comments_json_file = generate_safe_path(
+        '%s_comments.json' % filename_prefix, userconfig.outputdir, companion_exts=['jsonl'])
+
+    if is_replay_broadcast:
+        # ------------- REPLAY broadcast -------------
+        dl = ReplayDownloader(
+            mpd=mpd_url, output_dir=mpd_output_dir, user_agent=api.user_agent, session=create_session())
+        if downloaders is not None:
+            downloaders[broadcast['id']] = dl
+        duration = dl.duration
+        broadcast['duration'] = duration
+        if duration:
+            duration_mins, duration_secs = divmod(duration, 60)
+            if started_mins < 60:
+                started_label = '%dm %ds' % (started_mins, started_secs)
+            else:
+                started_label = '%dh %dm' % divmod(started_mins, 60)
+            broadcast_logger.info(
+                'Duration: %dm %ds \t\tStarted: %s ago' % (
+                    duration_mins, duration_secs, started_label)
+            )
+            broadcast_logger.info(rule_line)
+
+        # Detect if this replay has already been downloaded
+        if index and index.is_downloaded(broadcast):
+            # Already downloaded, so skip
+            broadcast_logger.warning('This broadcast is already downloaded.')
+            # Remove created empty folder
+            if os.path.isdir(mpd_output_dir):
+                os.rmdir(mpd_output_dir)
+            return
+
+        # Good to go
+        broadcast_logger.info('Downloading into %s ...' % mpd_output_dir)
+        broadcast_logger.info('[i] To interrupt the download, press CTRL+C')
+
+        final_output = generate_safe_path('%s.mp4' % filename_prefix, userconfig.outputdir)
+
+        # Collect comments concurrently with the video download
+        cdl = None
+        comment_thread_worker = None
+        if CommentFilter.is_enabled(userconfig):
+            cdl = CommentsDownloader(
+                api=api, broadcast=broadcast, destination_file=comments_json_file,
+                user_config=userconfig, logger=broadcast_logger)
+
+            def get_replay_comments():
+                broadcast_logger.info('Collecting comments...')
+                try:
+                    cdl.get_replay()
+                except Exception as e:
+                    broadcast_logger.error('Comment collection error: %s' % str(e))
+
+            comment_thread_worker = threading.Thread(target=get_replay_comments)
+            comment_thread_worker.start()
+
+        try:
+            generated_files = dl.download(
+                final_output, skipffmpeg=userconfig.skipffmpeg,
+                cleartempfiles=(not userconfig.nocleanup))
+
+            # Save meta file later after a successful download
+            # so that we don't trip up the downloaded check
+            with open(meta_json_file, 'w') as outfile:
+                json.dump(broadcast, outfile, indent=2)
+            if index:
+                index.add(broadcast, meta_json_file)
+            broadcast_logger.info('Download requests: %s' % dl.session.stats)
+            broadcast_logger.info(rule_line)
+
+            if not userconfig.skipffmpeg:
+                broadcast_logger.info('Generated file(s): \n%s' % '\n'.join(generated_files))
+            else:
+                broadcast_logger.info('Skipped generating file.')
+            broadcast_logger.info(rule_line)
+
+            if comment_thread_worker:
+                if comment_thread_worker.is_alive():
+                    broadcast_logger.info('Waiting for comments collection to complete...')
+                comment_thread_worker.join()
+
+                # Generate srt from comments collected
+                if cdl.comments:
+                    broadcast_logger.info('Generating comments file...')
+                    srt_filename = final_output.replace('.mp4', '.srt')
+                    CommentsDownloader.generate_srt(
+                        cdl.comments, broadcast['published_time'], srt_filename,
+                        comments_delay=0)
+                    broadcast_logger.info('Comments written to: %s' % srt_filename)
+                    broadcast_logger.info(rule_line)
+
+        except KeyboardInterrupt:
+            broadcast_logger.info('Download interrupted')
+        except Exception as e:
+            broadcast_logger.error('Unexpected Error: %s' % str(e))
+        finally:
+            if comment_thread_worker and comment_thread_worker.is_alive():
+                cdl.abort()
+                comment_thread_worker.join()
+
+        return    # Done with all replay processing
+
+    # ------------- LIVE broadcast -------------
+    # Every second spent before the first manifest is downloaded is lost footage,
+    # so anything not needed to start downloading is done in the background afterwards.
+    meta_lock = threading.Lock()
+
+    def save_meta():
+        with meta_lock, open(meta_json_file, 'w') as outfile:
+            json.dump(broadcast, outfile, indent=2)
+
+    def log_startup():
+        timer.mark('first manifest')
+        broadcast_logger.info('Startup: %s' % timer)
+
+    # Callback func used by downloaded to check if broadcast is still alive
+    heartbeat_times = []
+    # status from the story feed until the first heartbeat
+    last_heartbeat = {
+        'broadcast_status': broadcast['broadcast_status'], 'viewer_count': broadcast.get('viewer_count')}
+
+    def check_status():
+        heartbeat_start = time.time()
+        heartbeat_info = api.broadcast_heartbeat_and_viewercount(broadcast['id'])
+        heartbeat_times.append(time.time() - heartbeat_start)
+        last_heartbeat.update(heartbeat_info)
+        broadcast_logger.info('Broadcast Status Check: %s' % heartbeat_info['broadcast_status'])
+        return heartbeat_info['broadcast_status'] not in ['active', 'interrupted']
+
+    dl = LiveDownloader(
+        mpd=mpd_url,
+        output_dir=mpd_output_dir,
+        callback_check=check_status,
+        user_agent=api.user_agent,
+        mpd_download_timeout=userconfig.mpdtimeout,
+        download_timeout=userconfig.downloadtimeout,
+        duplicate_etag_retry=60,
+        ffmpegbinary=userconfig.ffmpegbinary,
+        incremental=userconfig.incremental,
+        on_first_mpd=log_startup if timer else None,
+        session=create_session(),
+        log_extra={'broadcast_id': broadcast['id']})
+    if downloaders is not None:
+        downloaders[broadcast['id']] = dl
+
+    # Generate the final output filename so that we can
+    final_output = generate_safe_path('%s.mp4' % filename_prefix, userconfig.outputdir)
+
+    cdl = None
+    if CommentFilter.is_enabled(userconfig):
+        cdl = CommentsDownloader(
+            api=api, broadcast=broadcast, destination_file=comments_json_file,
+            user_config=userconfig, logger=broadcast_logger)
+
+    # Call the api to collect comments for the stream
+    def get_comments():
+        broadcast_logger.info('Collecting comments...')
+        first_comment_created_at = 0
+        try:
+            while not cdl.aborted:
+                # Set initial_buffered_duration as soon as it's available
+                if 'initial_buffered_duration' not in broadcast and dl.initial_buffered_duration:
+                    broadcast['initial_buffered_duration'] = dl.initial_buffered_duration
+                    cdl.broadcast = broadcast
+                first_comment_created_at = cdl.get_live(first_comment_created_at)
+
+        except ClientError as e:
+            if 'media has been deleted' in e.error_response:
+                broadcast_logger.info('Stream end detected.')
+            else:
+                broadcast_logger.error('Comment collection ClientError: %d %s' % (e.code, e.error_response))
+
+        broadcast_logger.info('%d comments collected' % len(cdl.comments))
+
+        # do final save just in case
+        if cdl.comments:
+            cdl.save()
+            # Generate srt from comments collected
+            srt_filename = final_output.replace('.mp4', '.srt')
+            CommentsDownloader.generate_srt(
+                cdl.comments, download_start_time, srt_filename,
+                comments_delay=dl.initial_buffered_duration)
+            broadcast_logger.info('Comments written to: %s' % srt_filename)
+
+    def background_tasks():
+        save_meta()
+        if cdl:
+            get_comments()
+
+    def collect_metrics():
+        segments = list(dl.segment_perf.values())
+        values = {
+            'livestream_segments_downloaded_total': len(segments),
+            'livestream_bytes_written_total': sum([seg['size'] for seg in segments]),
+            'livestream_segment_lag_seconds': dl.segment_lag(),
+            'livestream_mpd_poll_failures_total': dl.mpd_failures,
+            'livestream_broadcast_active': int(last_heartbeat.get('broadcast_status') == 'active'),
+            'livestream_viewers': last_heartbeat.get('viewer_count'),
+        }
+        if cdl:
+            values['livestream_comments_collected'] = len(cdl.comments)
+            values['livestream_comment_poll_latency_seconds'] = cdl.poll_latency
+        return values
+
+    if metrics:
+        metrics.register(broadcast['id'], collect_metrics)
+
+    # Put the meta file write and comments collection into their own thread to run concurrently
+    background_worker = threading.Thread(target=background_tasks)
+    background_worker.start()
+
+    broadcast_logger.info('Downloading into %s ...' % mpd_output_dir)
+    broadcast_logger.info('[i] To interrupt the download, press CTRL+C')
+    if timer:
+        timer.mark('setup')
+    try:
+        dl.run()
+    except KeyboardInterrupt:
+        broadcast_logger.warning('Download interrupted.')
+        # Wait for download threads to complete
+        if not dl.is_aborted:
+            dl.stop()
+
+    finally:
+        # The download is done, so stop reporting it, before anything below can fail
+        if metrics:
+            metrics.unregister(broadcast['id'])
+
+        # Stop polling for comments. The comments thread finishes up while the files are assembled.
+        if cdl:
+            cdl.abort()
+
+        # Record the initial_buffered_duration
+        broadcast['initial_buffered_duration'] = dl.initial_buffered_duration
+        broadcast['segments'] = dl.segment_meta
+        save_meta()
+
+        missing = broadcast['delay'] - int(dl.initial_buffered_duration)
+        broadcast_logger.info('Recorded stream is missing %d seconds' % missing)
+        broadcast_logger.info('Download requests: %s' % dl.session.stats)
+
+        broadcast_logger.info('Assembling files....')
+
+        stitch_start = time.time()
+        generated_files = dl.stitch(
+            final_output, skipffmpeg=userconfig.skipffmpeg,
+            cleartempfiles=(not userconfig.nocleanup))
+        broadcast['perf'] = live_perf(
+            dl, timer=timer, heartbeat_times=heartbeat_times, stitch_time=time.time() - stitch_start)
+        save_meta()
+
+        broadcast_logger.info(rule_line)
+        if not userconfig.skipffmpeg:
+            broadcast_logger.info('Generated file(s): \n%s' % '\n'.join(generated_files))
+        else:
+            broadcast_logger.info('Skipped generating file.')
+        broadcast_logger.info(rule_line)
+
+        if index:
+            index.add(broadcast, meta_json_file)
+
+        if not userconfig.skipffmpeg and not userconfig.nocleanup:
+            shutil.rmtree(mpd_output_dir, ignore_errors=True)
+
+        # Wait for comments thread to complete
+        if background_worker.is_alive():
+            if cdl:
+                broadcast_logger.info('Waiting for comments download to complete...')
+            background_worker.join()
+
+        broadcast_logger.info('Performance: %s' % perf_summary(broadcast['perf']))
+
+        if userconfig.openwhendone and os.path.exists(final_output):
+            import webbrowser
+            webbrowser.open_new_tab('file://' + os.path.abspath(final_output))
+
+
+def download_replays(api, broadcasts, userconfig, index=None):
+    """
+    Download replay broadcasts concurrently, at most ``userconfig.replayworkers`` at a time.
+    Each replay is downloaded with its own ReplayDownloader into its own output files.
+
+    :param api: Client instance
+    :param broadcasts: list of replay broadcasts
+    :param userconfig: UserConfig instance
+    :param index: optional DownloadIndex to check and record completed downloads
+    """
+    max_workers = max(1, min(userconfig.replayworkers or 1, len(broadcasts)))
+    if max_workers == 1:
+        for broadcast in broadcasts:
+            download_broadcast(api, broadcast, userconfig, index=index)
+        return
+
+    logger.info('Downloading %d replays, %d at a time' % (len(broadcasts), max_workers))
+    pending = list(reversed(broadcasts))
+    state = {'completed': 0, 'aborted': False}
+    lock = threading.Lock()
+    # replay downloaders in progress, to stop them on CTRL+C
+    downloaders = {}
+
+    def worker():
+        while True:
+            with lock:
+                if state['aborted'] or not pending:
+                    return
+                broadcast = pending.pop()
+            download_broadcast(api, broadcast, userconfig, downloaders=downloaders, index=index)
+            with lock:
+                downloaders.pop(broadcast['id'], None)
+                if state['aborted']:
+                    return
+                state['completed'] += 1
+                logger.info('[%d/%d] Replay downloads completed' % (state['completed'], len(broadcasts)))
+
+    workers = [threading.Thread(target=worker) for _ in range(max_workers)]
+    for t in workers:
+        # so that a second CTRL+C can exit without waiting for them
+        t.daemon = True
+        t.start()
+
+    def join_workers():
+        # join with a timeout so that the main thread can still be interrupted
+        while any([t.is_alive() for t in workers]):
+            for t in workers:
+                t.join(1)
+
+    try:
+        join_workers()
+    except KeyboardInterrupt:
+        logger.warning('Download interrupted. Stopping the replay downloads in progress...')
+        with lock:
+            state['aborted'] = True
+            for dl in list(downloaders.values()):
+                dl.stop()
+        try:
+            join_workers()
+        except KeyboardInterrupt:
+            logger.warning('Exiting without waiting for the replay downloads to stop.')
+
+
 def run():
 
+    timer = PhaseTimer()
     description = ('INSTAGRAM LIVESTREAM DOWNLOADER (v%s) [python=%s.%s.%s,%s]'
                    % (__version__,
                       sys.version_info.major, sys.version_info.minor, sys.version_info.micro,
@@ -147,16 +693,20 @@ def run():
                         help='List of numeric IG user IDs to collect comments from.')
     parser.add_argument('-collectcomments', action='store_true',
                         help='Collect comments from verified users.')
+    parser.add_argument('-commentkeywords', metavar='REGEX', dest='commentkeywords', nargs='*',
+                        help='List of regex patterns. Collect comments with text matching any of them.')
+    parser.add_argument('-excludecommenters', metavar='COMMENTER_ID', dest='excludecommenters', nargs='*',
+                        help='List of numeric IG user IDs or usernames to never collect comments from.')
     parser.add_argument('-nocleanup', action='store_true',
                         help='Do not clean up temporary downloaded/generated files.')
     parser.add_argument('-openwhendone', action='store_true',
                         help='Automatically open movie file when completed.')
     parser.add_argument('-mpdtimeout', dest='mpdtimeout', type=int,
                         help='Set timeout interval in seconds for mpd download. Default %d.'
-                             % Downloader.MPD_DOWNLOAD_TIMEOUT)
+                             % MPD_DOWNLOAD_TIMEOUT)
     parser.add_argument('-downloadtimeout', dest='downloadtimeout', type=int,
                         help='Set timeout interval in seconds for segments download. Default %d.'
-                             % Downloader.DOWNLOAD_TIMEOUT)
+                             % DOWNLOAD_TIMEOUT)
     parser.add_argument('-ffmpegbinary', dest='ffmpegbinary', type=str,
                         help='Custom path to ffmpeg binary.')
     parser.add_argument('-skipffmpeg', dest='skipffmpeg', action='store_true',
@@ -165,6 +715,8 @@ def run():
                         help='Enable verbose debug messages.')
     parser.add_argument('-log', dest='log',
                         help='Log to file specified.')
+    parser.add_argument('-logformat', dest='logformat', choices=['text', 'json'],
+                        help='Log as text or as one json object per line. Default text.')
     parser.add_argument('-filenameformat', dest='filenameformat', type=str,
                         help='Custom filename format.')
     parser.add_argument('-noreplay', dest='noreplay', action='store_true',
@@ -173,56 +725,93 @@ def run():
                         help='Ignore the livestream_dl.cfg file.')
     parser.add_argument('-version', dest='version_check', action='store_true',
                         help='Show current version and check for new updates.')
+    parser.add_argument('-watchlist', dest='watchlist', type=str,
+                        help='File path to a list of IG users to watch and download from continuously.')
+    parser.add_argument('-watchinterval', dest='watchinterval', type=int,
+                        help='Interval in seconds between each check of the watch list. Default %d.'
+                             % Watcher.INTERVAL)
+    parser.add_argument('-nobatchcheck', dest='nobatchcheck', action='store_true',
+                        help='Check each user in the watch list with a separate api call. '
+                             'Required if the login user does not follow the watched users.')
+    parser.add_argument('-incremental', dest='incremental', action='store_true',
+                        help='Assemble segments as they are downloaded so that the final file '
+                             'is generated sooner when the stream ends.')
+    parser.add_argument('-usercachettl', dest='usercachettl', type=int,
+                        help='Seconds to cache the numeric IG user ID of a user name. Default %d.'
+                             % UserIdCache.TTL)
+    parser.add_argument('-nousercache', dest='nousercache', action='store_true',
+                        help='Do not save the numeric IG user IDs of user names to disk.')
+    parser.add_argument('-replayworkers', dest='replayworkers', type=int,
+                        help='Max number of replays to download at the same time. Default %d.'
+                             % REPLAY_WORKERS)
+    parser.add_argument('-metricsport', dest='metricsport', type=int,
+                        help='Serve the metrics of live downloads for Prometheus on this port.')
     argparser = parser.parse_args()
 
     # if not a version check or downloading for a selected user
-    if not (argparser.instagram_user or argparser.version_check):
+    if not (argparser.instagram_user or argparser.version_check or argparser.watchlist):
         parser.parse_args(['-h'])
         exit()
 
+    config_file = 'livestream_dl.cfg'
     if argparser.ignoreconfig:
         cfgparser = None
+        config_file = None
         logger.debug('Ignoring config file.')
 
     default_config = {
         'outputdir': 'downloaded',
         'commenters': [],
         'collectcomments': False,
+        'commentkeywords': [],
+        'excludecommenters': [],
         'nocleanup': False,
         'openwhendone': False,
-        'mpdtimeout': Downloader.MPD_DOWNLOAD_TIMEOUT,
-        'downloadtimeout': Downloader.DOWNLOAD_TIMEOUT,
+        'mpdtimeout': MPD_DOWNLOAD_TIMEOUT,
+        'downloadtimeout': DOWNLOAD_TIMEOUT,
         'verbose': False,
         'skipffmpeg': False,
+        'incremental': False,
         'ffmpegbinary': None,
+        'logformat': 'text',
         'filenameformat': '{year}{month}{day}_{username}_{broadcastid}_{broadcasttype}',
+        'watchinterval': Watcher.INTERVAL,
+        'replayworkers': REPLAY_WORKERS,
+        'usercachettl': UserIdCache.TTL,
     }
-    userconfig = UserConfig(
+    userconfig_source = UserConfig(
         config_section, defaults=default_config,
-        argparser=argparser, configparser=cfgparser)
+        argparser=argparser, configparser=cfgparser, config_file=config_file)
+    try:
+        userconfig = userconfig_source.resolve()
+    except ValueError as e:
+        logger.error(str(e))
+        exit(9)
 
     if userconfig.verbose:
         logger.setLevel(logging.DEBUG)
         api_logger.setLevel(logging.DEBUG)
-        dash_logger.setLevel(logging.DEBUG)
-        replay_dash_logger.setLevel(logging.DEBUG)
     else:
         logger.setLevel(logging.INFO)
-        dash_logger.setLevel(logging.INFO)
-        replay_dash_logger.setLevel(logging.INFO)
 
+    log_handlers = [ch]
     if userconfig.log:
         file_handler = logging.FileHandler(userconfig.log)
         file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s'))
-        logger.addHandler(file_handler)
-        dash_logger.addHandler(file_handler)
-        replay_dash_logger.addHandler(file_handler)
-        api_logger.addHandler(file_handler)
+        log_handlers.append(file_handler)
+    if userconfig.logformat == 'json':
+        for handler in log_handlers:
+            handler.setFormatter(JsonFormatter())
+    # write the logs from a listener thread so that the downloads don't wait on them
+    start_log_listener([logger, api_logger], log_handlers)
 
     logger.info(description)
 
     if userconfig.verbose:
-        check_ffmpeg(userconfig.ffmpegbinary)
+        # informational only, so don't hold up the download for it
+        ffmpeg_check_worker = threading.Thread(target=check_ffmpeg, args=(userconfig.ffmpegbinary, ))
+        ffmpeg_check_worker.daemon = True
+        ffmpeg_check_worker.start()
 
     if argparser.version_check:
         message = check_for_updates(__version__)
@@ -233,7 +822,7 @@ def run():
 
     logger.info('=-' * 40)
 
-    if not argparser.instagram_user:
+    if not (argparser.instagram_user or userconfig.watchlist):
         exit()
 
     user_username = userconfig.username or os.getenv(USERNAME_ENV_KEY)
@@ -241,73 +830,62 @@ def run():
         logger.error('No login username specified.')
         exit(9)
 
+    import getpass
+    from instagram_private_api import ClientError, ClientLoginRequiredError
+
     user_password = (userconfig.password or os.getenv(PASSWORD_ENV_KEY) or
                      getpass.getpass(
                          prompt='Type in the password for %s and press "Enter" '
                                 '\n(Your password will not show on screen): '
                                 % user_username))
     settings_file_path = userconfig.settings or ('%s.json' % user_username)
-
-    # don't use default device profile
-    custom_device = {
-        'phone_manufacturer': 'samsung',
-        'phone_model': 'hero2lte',
-        'phone_device': 'SM-G935F',
-        'android_release': '6.0.1',
-        'android_version': 23,
-        'phone_dpi': '640dpi',
-        'phone_resolution': '1440x2560',
-        'phone_chipset': 'samsungexynos8890'
-    }
-
-    api = None
-    try:
-        if not os.path.isfile(settings_file_path):
-            # login afresh
-            api = Client(
-                user_username, user_password,
-                on_login=lambda x: onlogin_callback(x, settings_file_path),
-                **custom_device)
-        else:
-            # reuse cached auth
-            with open(settings_file_path) as file_data:
-                cached_settings = json.load(file_data, object_hook=from_json)
-
-            # always use latest app ver, sig key, etc from lib
-            for key in ('app_version', 'signature_key', 'key_version', 'ig_capabilities'):
-                cached_settings.pop(key, None)
-            api = Client(
-                user_username, user_password,
-                settings=cached_settings,
-                **custom_device)
-
-    except (ClientCookieExpiredError, ClientLoginRequiredError) as e:
-        logger.warning('ClientCookieExpiredError/ClientLoginRequiredError: %s' % e)
-        api = Client(
-            user_username, user_password,
-            on_login=lambda x: onlogin_callback(x, settings_file_path),
-            **custom_device)
-
-    except ClientError as e:
-        logger.error('ClientError %s (Code: %d, Response: %s)' % (e.msg, e.code, e.error_response))
-        exit(9)
-
-    except Exception as e:
-        logger.error('Unexpected Exception: %s' % e)
-        exit(99)
-
-    if not api:
-        logger.error('Unable to init api client')
-        exit(99)
-
-    if user_username != api.authenticated_user_name:
-        logger.warning(
-            'Authenticated username mismatch: %s vs %s'
-            % (user_username, api.authenticated_user_name))
+    timer.mark('config')
+
+    api = init_client(user_username, user_password, settings_file_path)
+    timer.mark('login')
+
+    user_cache = UserIdCache(
+        UserIdCache.path_for(settings_file_path) if not userconfig.nousercache else None,
+        ttl=userconfig.usercachettl, logger=logger)
+
+    # check if output dir exists, create if otherwise
+    if not os.path.exists(userconfig.outputdir):
+        os.makedirs(userconfig.outputdir)
+    # opened on first use, i.e. not before a live download starts
+    index = DownloadIndex(userconfig.outputdir, logger=logger)
+    indexes = {userconfig.outputdir: index}
+    indexes_lock = threading.Lock()
+
+    def index_for(config):
+        """Index of the config's output folder, which can change when the watcher reloads the config."""
+        with indexes_lock:
+            if config.outputdir not in indexes:
+                indexes[config.outputdir] = DownloadIndex(config.outputdir, logger=logger)
+            return indexes[config.outputdir]
+
+    metrics = None
+    if userconfig.metricsport:
+        from .metrics import MetricsServer
+        metrics = MetricsServer(userconfig.metricsport, logger=logger).start()
+
+    if userconfig.watchlist:
+        watcher = Watcher(
+            api, read_watch_list(userconfig.watchlist),
+            on_broadcast=lambda client, broadcast, config, downloaders: download_broadcast(
+                client, broadcast, config, downloaders=downloaders, index=index_for(config), metrics=metrics),
+            logger=logger,
+            userconfig=userconfig,
+            config_source=userconfig_source,
+            user_cache=user_cache,
+            relogin=lambda: login(user_username, user_password, settings_file_path))
+        watcher.run()
+        exit(0)
 
     retry_attempts = 2
     res = {}
     ig_user_id = ''
+    # if the user ID came from the cache, it may be stale
+    is_cached_user_id = False
     for i in range(1, 1 + retry_attempts):
         try:
             # Alow user to save an api call if they directly specify the IG numeric user ID
@@ -315,25 +893,32 @@ def run():
                 # is a numeric IG user ID
                 ig_user_id = argparser.instagram_user
             else:
-                # regular ig user name
-                user_res = api.username_info(argparser.instagram_user)
-                ig_user_id = user_res['user']['pk']
+                # regular ig user name, the user ID is cached to save an api call
+                is_cached_user_id = bool(user_cache.get(argparser.instagram_user))
+                ig_user_id = user_cache.lookup(api, argparser.instagram_user)
+            timer.mark('user lookup')
 
             res = api.user_story_feed(ig_user_id)
+            timer.mark('feed')
             break
 
         except ClientLoginRequiredError as e:
             if i < retry_attempts:
                 # Probably because user has changed password somewhere else
                 logger.warning('ClientLoginRequiredError. Logging in again...')
-                api = Client(
-                    user_username, user_password,
-                    on_login=lambda x: onlogin_callback(x, settings_file_path),
-                    **custom_device)
+                api = login(user_username, user_password, settings_file_path)
+            else:
+                raise e
+
+        except ClientError as e:
+            if i < retry_attempts and is_cached_user_id:
+                # Cached user ID may be stale, e.g. the user name now belongs to another account
+                logger.warning('ClientError: %d %s. Looking up user again...' % (e.code, e.error_response))
+                user_cache.invalidate(argparser.instagram_user)
             else:
                 raise e
 
-        except (SSLError, timeout, URLError, HTTPException, SocketError) as e:
+        except network_errors() as e:
             if i < retry_attempts:
                 logger.warning(str(e))
                 time.sleep(userconfig.downloadtimeout)
@@ -341,248 +926,12 @@ def run():
                 logger.error(str(e))
                 exit(99)
 
-    if not res.get('broadcast') and (
-            userconfig.noreplay or
-            not res.get('post_live_item', {}).get('broadcasts')):
+    broadcasts = get_broadcasts(res, noreplay=userconfig.noreplay)
+    if not broadcasts:
         logger.info('No broadcast from %s' % ig_user_id)
         exit(0)
 
-    if res.get('broadcast'):
-        broadcasts = [res['broadcast']]
+    if is_replay(broadcasts[0]):
+        download_replays(api, broadcasts, userconfig, index=index)
     else:
-        broadcasts = res['post_live_item']['broadcasts']
-
-    for broadcast in broadcasts:
-        if broadcast['broadcast_status'] not in ['active', 'post_live']:
-            # Usually because it's interrupted
-            logger.warning('Broadcast status is currently: %s' % broadcast['broadcast_status'])
-
-        # check if output dir exists, create if otherwise
-        if not os.path.exists(userconfig.outputdir):
-            os.makedirs(userconfig.outputdir)
-
-        is_replay_broadcast = is_replay(broadcast)
-
-        download_start_time = int(time.time())
-        filename_prefix = generate_filename_prefix(broadcast, userconfig)
-
-        # dash_abr_playback_url has the higher def stream
-        mpd_url = (broadcast.get('dash_manifest')
-                   or broadcast.get('dash_abr_playback_url')
-                   or broadcast['dash_playback_url'])
-
-        # Print broadcast info to console
-        logger.info(rule_line)
-        started_mins, started_secs = divmod((int(time.time()) - broadcast['published_time']), 60)
-        logger.info('Broadcast by: %s \t(%s)\tType: %s' % (
-            broadcast['broadcast_owner']['username'],
-            broadcast['id'],
-            'Live' if not is_replay_broadcast else 'Replay')
-        )
-        if not is_replay_broadcast:
-            started_label = '%dm' % started_mins
-            if started_secs:
-                started_label += ' %ds' % started_secs
-            logger.info(
-                'Viewers: %d \t\tStarted: %s ago' % (
-                    broadcast.get('viewer_count', 0),
-                    started_label)
-            )
-            logger.info('Dash URL: %s' % mpd_url)
-            logger.info(rule_line)
-
-        # Record the delay = duration of the stream that has been missed
-        broadcast['delay'] = ((download_start_time - broadcast['published_time'])
-                              if not is_replay_broadcast else 0)
-
-        # folder path for downloaded segments
-        mpd_output_dir = generate_safe_path(
-            '%s_downloads' % filename_prefix, userconfig.outputdir, is_file=False)
-
-        # file path to save the stream's info
-        meta_json_file = generate_safe_path('%s.json' % filename_prefix, userconfig.outputdir)
-
-        # file path to save collected comments
-        comments_json_file = generate_safe_path('%s_comments.json' % filename_prefix, userconfig.outputdir)
-
-        if is_replay_broadcast:
-            # ------------- REPLAY broadcast -------------
-            dl = ReplayDownloader(mpd=mpd_url, output_dir=mpd_output_dir, user_agent=api.user_agent)
-            duration = dl.duration
-            broadcast['duration'] = duration
-            if duration:
-                duration_mins, duration_secs = divmod(duration, 60)
-                if started_mins < 60:
-                    started_label = '%dm %ds' % (started_mins, started_secs)
-                else:
-                    started_label = '%dh %dm' % divmod(started_mins, 60)
-                logger.info(
-                    'Duration: %dm %ds \t\tStarted: %s ago' % (
-                        duration_mins, duration_secs, started_label)
-                )
-                logger.info(rule_line)
-
-            # Detect if this replay has already been downloaded
-            if glob.glob(os.path.join(userconfig.outputdir, '%s.*' % filename_prefix)):
-                # Already downloaded, so skip
-                logger.warning('This broadcast is already downloaded.')
-                # Remove created empty folder
-                if os.path.isdir(mpd_output_dir):
-                    os.rmdir(mpd_output_dir)
-                continue
-
-            # Good to go
-            logger.info('Downloading into %s ...' % mpd_output_dir)
-            logger.info('[i] To interrupt the download, press CTRL+C')
-
-            final_output = generate_safe_path('%s.mp4' % filename_prefix, userconfig.outputdir)
-            try:
-                generated_files = dl.download(
-                    final_output, skipffmpeg=userconfig.skipffmpeg,
-                    cleartempfiles=(not userconfig.nocleanup))
-
-                # Save meta file later after a successful download
-                # so that we don't trip up the downloaded check
-                with open(meta_json_file, 'w') as outfile:
-                    json.dump(broadcast, outfile, indent=2)
-                logger.info(rule_line)
-
-                if not userconfig.skipffmpeg:
-                    logger.info('Generated file(s): \n%s' % '\n'.join(generated_files))
-                else:
-                    logger.info('Skipped generating file.')
-                logger.info(rule_line)
-
-                if userconfig.commenters or userconfig.collectcomments:
-                    logger.info('Collecting comments...')
-                    cdl = CommentsDownloader(
-                        api=api, broadcast=broadcast, destination_file=comments_json_file,
-                        user_config=userconfig, logger=logger)
-                    cdl.get_replay()
-
-                    # Generate srt from comments collected
-                    if cdl.comments:
-                        logger.info('Generating comments file...')
-                        srt_filename = final_output.replace('.mp4', '.srt')
-                        CommentsDownloader.generate_srt(
-                            cdl.comments, broadcast['published_time'], srt_filename,
-                            comments_delay=0)
-                        logger.info('Comments written to: %s' % srt_filename)
-                        logger.info(rule_line)
-
-            except KeyboardInterrupt:
-                logger.info('Download interrupted')
-            except Exception as e:
-                logger.error('Unexpected Error: %s' % str(e))
-
-            continue    # Done with all replay processing
-
-        # ------------- LIVE broadcast -------------
-        with open(meta_json_file, 'w') as outfile:
-            json.dump(broadcast, outfile, indent=2)
-
-        job_aborted = False
-
-        # Callback func used by downloaded to check if broadcast is still alive
-        def check_status():
-            heartbeat_info = api.broadcast_heartbeat_and_viewercount(broadcast['id'])
-            logger.info('Broadcast Status Check: %s' % heartbeat_info['broadcast_status'])
-            return heartbeat_info['broadcast_status'] not in ['active', 'interrupted']
-
-        dl = Downloader(
-            mpd=mpd_url,
-            output_dir=mpd_output_dir,
-            callback_check=check_status,
-            user_agent=api.user_agent,
-            mpd_download_timeout=userconfig.mpdtimeout,
-            download_timeout=userconfig.downloadtimeout,
-            duplicate_etag_retry=60,
-            ffmpegbinary=userconfig.ffmpegbinary)
-
-        # Generate the final output filename so that we can
-        final_output = generate_safe_path('%s.mp4' % filename_prefix, userconfig.outputdir)
-
-        # Call the api to collect comments for the stream
-        def get_comments():
-            logger.info('Collecting comments...')
-            cdl = CommentsDownloader(
-                api=api, broadcast=broadcast, destination_file=comments_json_file,
-                user_config=userconfig, logger=logger)
-            first_comment_created_at = 0
-            try:
-                while not job_aborted:
-                    # Set initial_buffered_duration as soon as it's available
-                    if 'initial_buffered_duration' not in broadcast and dl.initial_buffered_duration:
-                        broadcast['initial_buffered_duration'] = dl.initial_buffered_duration
-                        cdl.broadcast = broadcast
-                    first_comment_created_at = cdl.get_live(first_comment_created_at)
-
-            except ClientError as e:
-                if 'media has been deleted' in e.error_response:
-                    logger.info('Stream end detected.')
-                else:
-                    logger.error('Comment collection ClientError: %d %s' % (e.code, e.error_response))
-
-            logger.info('%d comments collected' % len(cdl.comments))
-
-            # do final save just in case
-            if cdl.comments:
-                cdl.save()
-                # Generate srt from comments collected
-                srt_filename = final_output.replace('.mp4', '.srt')
-                CommentsDownloader.generate_srt(
-                    cdl.comments, download_start_time, srt_filename,
-                    comments_delay=dl.initial_buffered_duration)
-                logger.info('Comments written to: %s' % srt_filename)
-
-        # Put comments collection into its own thread to run concurrently
-        comment_thread_worker = None
-        if userconfig.commenters or userconfig.collectcomments:
-            comment_thread_worker = threading.Thread(target=get_comments)
-            comment_thread_worker.start()
-
-        logger.info('Downloading into %s ...' % mpd_output_dir)
-        logger.info('[i] To interrupt the download, press CTRL+C')
-        try:
-            dl.run()
-        except KeyboardInterrupt:
-            logger.warning('Download interrupted.')
-            # Wait for download threads to complete
-            if not dl.is_aborted:
-                dl.stop()
-
-        finally:
-            job_aborted = True
-
-            # Record the initial_buffered_duration
-            broadcast['initial_buffered_duration'] = dl.initial_buffered_duration
-            broadcast['segments'] = dl.segment_meta
-            with open(meta_json_file, 'w') as outfile:
-                json.dump(broadcast, outfile, indent=2)
-
-            missing = broadcast['delay'] - int(dl.initial_buffered_duration)
-            logger.info('Recorded stream is missing %d seconds' % missing)
-
-            # Wait for comments thread to complete
-            if comment_thread_worker and comment_thread_worker.is_alive():
-                logger.info('Stopping comments download...')
-                comment_thread_worker.join()
-
-            logger.info('Assembling files....')
-
-            generated_files = dl.stitch(
-                final_output, skipffmpeg=userconfig.skipffmpeg,
-                cleartempfiles=(not userconfig.nocleanup))
-
-            logger.info(rule_line)
-            if not userconfig.skipffmpeg:
-                logger.info('Generated file(s): \n%s' % '\n'.join(generated_files))
-            else:
-                logger.info('Skipped generating file.')
-            logger.info(rule_line)
-
-            if not userconfig.skipffmpeg and not userconfig.nocleanup:
-                shutil.rmtree(mpd_output_dir, ignore_errors=True)
-
-            if userconfig.openwhendone and os.path.exists(final_output):
-                webbrowser.open_new_tab('file://' + os.path.abspath(final_output))
+        download_broadcast(api, broadcasts[0], userconfig, index=index, timer=timer, metrics=metrics)
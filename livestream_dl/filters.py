@@ -0,0 +1,85 @@
+import re
+
+
+class CommentFilter(object):
+    """
+    Selects the comments to collect.
+
+    The rules are compiled once into hashed sets and a single regex so that
+    filtering a batch of comments does not depend on the size of the watch lists.
+
+    A comment is collected if its user is not excluded and any of the following is true:
+
+    - the user's numeric ID or username is in ``commenters``
+    - the user is verified
+    - the comment text matches one of the ``keywords`` regexes
+    """
+
+    def __init__(self, commenters=None, keywords=None, exclude=None, verified=True):
+        """
+
+        :param commenters: list of numeric IG user IDs and/or usernames
+        :param keywords: list of regex patterns to match against the comment text
+        :param exclude: list of numeric IG user IDs and/or usernames to never collect from
+        :param verified: bool flag to collect comments from verified users
+        """
+        self.commenters = frozenset([str(c) for c in commenters or []])
+        self.exclude = frozenset([str(c) for c in exclude or []])
+        self.keywords_re = self.compile_keywords(keywords)
+        self.verified = verified
+
+    @staticmethod
+    def compile_keywords(keywords):
+        """
+        Compile the keyword patterns into a single regex.
+
+        :param keywords: list of regex patterns
+        :return: compiled regex, or None if there are no patterns
+        :raises ValueError: if a pattern is invalid
+        """
+        if not keywords:
+            return None
+        for k in keywords:
+            # checked one by one to name the invalid pattern
+            try:
+                re.compile(k)
+            except re.error as e:
+                raise ValueError('Invalid comment keyword regex "%s": %s' % (k, e))
+        return re.compile('|'.join(['(?:%s)' % k for k in keywords]), re.IGNORECASE | re.UNICODE)
+
+    @staticmethod
+    def is_enabled(user_config):
+        """Check if comments should be collected at all."""
+        return bool(
+            user_config.commenters or user_config.collectcomments or
+            user_config.commentkeywords)
+
+    @classmethod
+    def from_config(cls, user_config):
+        return cls(
+            commenters=user_config.commenters,
+            keywords=user_config.commentkeywords,
+            exclude=user_config.excludecommenters)
+
+    def match(self, user_id, user, text):
+        """Check if a comment should be collected."""
+        username = user.get('username', '')
+        if user_id in self.exclude or username in self.exclude:
+            return False
+        if user_id in self.commenters or username in self.commenters:
+            return True
+        if self.verified and user.get('is_verified'):
+            return True
+        if self.keywords_re and text and self.keywords_re.search(text):
+            return True
+        return False
+
+    def apply_live(self, comments):
+        """Filter a batch of live comments."""
+        return [c for c in comments if self.match(str(c['user_id']), c['user'], c.get('text'))]
+
+    def apply_replay(self, comments):
+        """Filter a batch of replay comments, which wrap the comment info in 'comment'."""
+        return [
+            c for c in comments
+            if self.match(str(c['comment']['user']['pk']), c['comment']['user'], c['comment'].get('text'))]
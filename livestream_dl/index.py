@@ -0,0 +1,101 @@
+import os
+import glob
+import json
+import time
+import threading
+
+from .discovery import is_replay
+
+
+class DownloadIndex(object):
+    """
+    Persistent index of the broadcasts downloaded into an output folder,
+    so that checking if a broadcast has been downloaded does not require
+    scanning the folder.
+
+    The database is opened on first use so that it is not on the critical
+    path of starting a live download.
+    """
+
+    FILENAME = 'livestream_dl.sqlite'
+
+    def __init__(self, output_dir, logger=None):
+        self.output_dir = output_dir
+        self.db_file = os.path.join(output_dir, self.FILENAME)
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.open_lock = threading.Lock()
+        self.conn = None
+
+    def connection(self):
+        """The database connection, opened on first use. A new database is backfilled."""
+        with self.open_lock:
+            if self.conn is None:
+                # imported here to keep it off the startup path
+                import sqlite3
+                is_new = not os.path.isfile(self.db_file)
+                conn = sqlite3.connect(self.db_file, timeout=30, check_same_thread=False)
+                with self.lock, conn:
+                    conn.execute(
+                        'CREATE TABLE IF NOT EXISTS downloads ('
+                        'broadcast_id TEXT NOT NULL, '
+                        'broadcast_type TEXT NOT NULL, '
+                        'meta_file TEXT, '
+                        'completed_at INTEGER, '
+                        'PRIMARY KEY (broadcast_id, broadcast_type))')
+                self.conn = conn
+                if is_new:
+                    self.backfill()
+            return self.conn
+
+    @staticmethod
+    def broadcast_type(broadcast):
+        return 'replay' if is_replay(broadcast) else 'live'
+
+    def backfill(self):
+        """Index the broadcasts from the meta json files already in the output folder."""
+        records = []
+        for meta_file in glob.glob(os.path.join(self.output_dir, '*.json')):
+            if meta_file.endswith('_comments.json'):
+                continue
+            try:
+                with open(meta_file) as info_file:
+                    broadcast = json.load(info_file)
+                records.append((
+                    str(broadcast['id']), self.broadcast_type(broadcast),
+                    os.path.basename(meta_file), int(os.path.getmtime(meta_file))))
+            except (ValueError, KeyError, TypeError, IOError, OSError):
+                # not a broadcast meta file
+                continue
+        with self.lock, self.conn:
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO downloads '
+                '(broadcast_id, broadcast_type, meta_file, completed_at) VALUES (?, ?, ?, ?)',
+                records)
+        if self.logger and records:
+            self.logger.debug('Indexed %d existing broadcast(s) in %s' % (len(records), self.db_file))
+
+    def is_downloaded(self, broadcast):
+        """Check if the broadcast has already been downloaded."""
+        conn = self.connection()
+        with self.lock:
+            row = conn.execute(
+                'SELECT 1 FROM downloads WHERE broadcast_id = ? AND broadcast_type = ?',
+                (str(broadcast['id']), self.broadcast_type(broadcast))).fetchone()
+        return row is not None
+
+    def add(self, broadcast, meta_file):
+        """Record a completed download."""
+        conn = self.connection()
+        with self.lock, conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO downloads '
+                '(broadcast_id, broadcast_type, meta_file, completed_at) VALUES (?, ?, ?, ?)',
+                (str(broadcast['id']), self.broadcast_type(broadcast),
+                 os.path.basename(meta_file), int(time.time())))
+
+    def close(self):
+        with self.open_lock, self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
@@ -0,0 +1,279 @@
+import os
+import time
+import bisect
+import logging
+import threading
+import subprocess
+
+import requests
+from instagram_private_api_extensions.live import Downloader, logger
+
+from .concat import copy_into
+
+
+class SegmentAssembler(object):
+    """
+    Appends downloaded segments to the audio and video source files, in order,
+    as soon as they are completed so that only the final mux is left when
+    the stream ends.
+    """
+
+    AUDIO_STREAM_FORMAT = 'source_{0}_{1}_mp4.tmp'
+    VIDEO_STREAM_FORMAT = 'source_{0}_{1}_m4a.tmp'
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.lock = threading.Lock()
+        self.pending = []
+        self.completed = set()
+        self.assembled = []
+        self.sources = []
+        self.prev_res = ''
+        self.video_stream = ''
+        self.audio_stream = ''
+        self.video_file = None
+        self.audio_file = None
+        self.segment_meta = {}
+
+    def register(self, segment, representation):
+        """Add a segment found in the mpd. Segments are assembled in order of their index."""
+        with self.lock:
+            if segment in self.segment_meta:
+                return
+            self.segment_meta[segment] = representation
+            bisect.insort(self.pending, (Downloader._get_file_index(segment), segment))
+
+    def complete(self, segment, stream_id):
+        """
+        Mark a video or audio segment download as done, successfully or not, and assemble what's ready.
+        A segment is ready when both its video and audio downloads are done.
+        """
+        with self.lock:
+            self.completed.add(segment)
+            self._flush(stream_id)
+
+    def finish(self, stream_id):
+        """Assemble all remaining segments and return the list of source file pairs."""
+        with self.lock:
+            self._flush(stream_id, final=True)
+            self._close_files()
+            sources = list(self.sources)
+            if self.audio_stream and self.video_stream:
+                # push last pair into source
+                sources.append({'video': self.video_stream, 'audio': self.audio_stream})
+            return sources
+
+    def _is_ready(self, segment):
+        return segment in self.completed and segment.replace('.m4v', '.m4a') in self.completed
+
+    def _flush(self, stream_id, final=False):
+        while self.pending and (final or self._is_ready(self.pending[0][1])):
+            _, segment = self.pending.pop(0)
+            self.completed.discard(segment)
+            self.completed.discard(segment.replace('.m4v', '.m4a'))
+            self._append(segment, stream_id)
+
+    def _close_files(self):
+        for f in (self.video_file, self.audio_file):
+            if f:
+                f.close()
+        self.video_file = None
+        self.audio_file = None
+
+    def _append(self, segment, stream_id):
+        seg_file = os.path.join(self.output_dir, segment)
+        if not os.path.isfile(seg_file):
+            logger.warning('Segment not found: {0!s}'.format(segment))
+            return
+        if not os.path.isfile(seg_file.replace('.m4v', '.m4a')):
+            logger.warning('Segment not found: {0!s}'.format(segment.replace('.m4v', '.m4a')))
+            return
+
+        if not self.video_stream or (self.prev_res and self.prev_res != self.segment_meta[segment]):
+            if self.video_stream:
+                # resolution change detected
+                # push current generated file pair into sources
+                self.sources.append({'video': self.video_stream, 'audio': self.audio_stream})
+            self._close_files()
+            self.video_stream = os.path.join(
+                self.output_dir, self.VIDEO_STREAM_FORMAT.format(stream_id, len(self.sources)))
+            self.audio_stream = os.path.join(
+                self.output_dir, self.AUDIO_STREAM_FORMAT.format(stream_id, len(self.sources)))
+            self.video_file = open(self.video_stream, 'wb')
+            self.audio_file = open(self.audio_stream, 'wb')
+        self.prev_res = self.segment_meta[segment]
+
+        copy_into(seg_file, self.video_file)
+        copy_into(seg_file.replace('.m4v', '.m4a'), self.audio_file)
+        self.assembled.append(segment)
+        logger.debug('Assembled {0!s} => {1!s}'.format(segment, os.path.basename(self.video_stream)))
+
+
+def generate_source_filename(output_filename, n, sources_count):
+    """
+    Use the output filename as-is if there is only one source.
+    Otherwise, append n+1 so that it looks like output-1.mp4, output-2.mp4, etc
+    """
+    if sources_count == 1:
+        return output_filename
+    dir_name = os.path.dirname(output_filename)
+    filename_no_ext, ext = os.path.splitext(os.path.basename(output_filename))
+    return os.path.join(dir_name, '{0!s}-{1:d}{2!s}'.format(filename_no_ext, n + 1, ext))
+
+
+class LiveDownloader(Downloader):
+    """
+    Live stream Downloader that can optionally assemble the segments
+    incrementally while the stream is still being downloaded.
+    Segments are concatenated with in-kernel copies where available.
+
+    The download time and size of every segment is recorded in ``segment_perf``
+    and the time taken by ffmpeg in ``mux_time``. Failed mpd downloads are
+    counted in ``mpd_failures``.
+    """
+
+    def __init__(self, mpd, output_dir, callback_check=None, singlethreaded=False, user_agent=None, **kwargs):
+        incremental = kwargs.pop('incremental', False)
+        # called once the first mpd has been downloaded
+        self.on_first_mpd = kwargs.pop('on_first_mpd', None)
+        # requests Session to use instead of the downloader's own, e.g. one with a shared connection pool
+        session = kwargs.pop('session', None)
+        # extra fields for the log records of each downloaded segment, e.g. the broadcast ID
+        self.log_extra = kwargs.pop('log_extra', None) or {}
+        super(LiveDownloader, self).__init__(
+            mpd, output_dir, callback_check=callback_check,
+            singlethreaded=singlethreaded, user_agent=user_agent, **kwargs)
+        if session is not None:
+            self.session = session
+        self.assembler = SegmentAssembler(output_dir) if incremental else None
+        self.run_start_time = None
+        self.first_segment_time = None
+        self.segment_perf = {}
+        self.mux_time = 0.0
+        self.mpd_failures = 0
+        # segment => time first listed in the mpd, None once its download is done, successfully or not
+        self.listed_since = {}
+
+    def run(self):
+        self.run_start_time = time.time()
+        super(LiveDownloader, self).run()
+
+    def _download_mpd(self):
+        try:
+            res = super(LiveDownloader, self)._download_mpd()
+        except (requests.HTTPError, requests.ConnectionError):
+            self.mpd_failures += 1
+            raise
+        if self.on_first_mpd:
+            callback, self.on_first_mpd = self.on_first_mpd, None
+            callback()
+        return res
+
+    def _store_segment_meta(self, segment, representation):
+        super(LiveDownloader, self)._store_segment_meta(segment, representation)
+        if self.assembler:
+            self.assembler.register(segment, representation)
+
+    def _extract(self, identifier, target, output, init_chunk=None):
+        if identifier not in self.listed_since:
+            self.listed_since[identifier] = time.time()
+        super(LiveDownloader, self)._extract(identifier, target, output, init_chunk=init_chunk)
+
+    def segment_lag(self):
+        """Seconds since the oldest segment listed in the mpd that is not downloaded yet was first listed."""
+        pending = [t for t in list(self.listed_since.values()) if t is not None]
+        return max(0.0, time.time() - min(pending)) if pending else 0.0
+
+    def _download(self, target, output, timeout=None, init_chunk=None):
+        start = time.time()
+        try:
+            res = super(LiveDownloader, self)._download(
+                target, output, timeout=timeout, init_chunk=init_chunk)
+        finally:
+            # errors other than HTTPError and ConnectionError, e.g. ReadTimeout, are raised,
+            # so always mark the segment as done for it not to hold up the assembly
+            if output:
+                self.listed_since[os.path.basename(output)] = None
+                self._record_segment(os.path.basename(output), output, time.time() - start)
+                if self.assembler:
+                    self.assembler.complete(os.path.basename(output), self.stream_id)
+        return res
+
+    def _record_segment(self, segment, output, duration):
+        if not os.path.isfile(output):
+            # failed download
+            return
+        now = time.time()
+        if not self.first_segment_time or now < self.first_segment_time:
+            self.first_segment_time = now
+        self.segment_perf[segment] = {'latency': round(duration, 3), 'size': os.path.getsize(output)}
+        extra = dict(self.log_extra, segment=segment, **self.segment_perf[segment])
+        logger.debug('Downloaded {0!s} in {1:.2f}s'.format(segment, duration), extra=extra)
+
+    def stitch(self, output_filename, skipffmpeg=False, cleartempfiles=True):
+        """
+        Combines all the dowloaded stream segments into the final mp4 file.
+        If assembling incrementally, only the remaining segments are appended before muxing.
+
+        :param output_filename: Output file path
+        :param skipffmpeg: bool flag to not use ffmpeg to join audio and video file into final mp4
+        :param cleartempfiles: bool flag to remove downloaded and temp files
+        """
+        if not self.stream_id:
+            raise ValueError('No stream ID found.')
+
+        assembler = self.assembler
+        if not assembler:
+            # assemble everything now
+            assembler = SegmentAssembler(self.output_dir)
+            for segment, representation in self.segment_meta.items():
+                assembler.register(segment, representation)
+        sources = assembler.finish(self.stream_id)
+        if len(sources) > 1:
+            logger.warning(
+                'Stream has sections with different resolutions.\n'
+                '{0:d} mp4 files will be generated in total.'.format(len(sources)))
+
+        has_ffmpeg_error = False
+        files_generated = []
+        if not skipffmpeg:
+            for n, source in enumerate(sources):
+                generated_filename = generate_source_filename(output_filename, n, len(sources))
+                ffmpeg_loglevel = 'error'
+                if logger.level == logging.DEBUG:
+                    ffmpeg_loglevel = 'warning'
+                cmd = [
+                    self.ffmpeg_binary, '-y',
+                    '-loglevel', ffmpeg_loglevel,
+                    '-i', source['audio'],
+                    '-i', source['video'],
+                    '-c:v', 'copy',
+                    '-c:a', 'copy',
+                    generated_filename]
+                mux_start = time.time()
+                exit_code = subprocess.call(cmd)
+                self.mux_time += time.time() - mux_start
+
+                if exit_code:
+                    logger.error('ffmpeg exited with the code: {0!s}'.format(exit_code))
+                    logger.error('Command: {0!s}'.format(' '.join(cmd)))
+                    has_ffmpeg_error = True
+                else:
+                    files_generated.append(generated_filename)
+                    if cleartempfiles:
+                        for f in (source['audio'], source['video']):
+                            try:
+                                os.remove(f)
+                            except (IOError, OSError) as ioe:
+                                logger.warning('Error removing {0!s}: {1!s}'.format(f, str(ioe)))
+
+        if cleartempfiles and not has_ffmpeg_error:
+            # Specifically only remove this stream's segment files
+            for seg in self.segment_meta.keys():
+                for f in (seg, seg.replace('.m4v', '.m4a')):
+                    try:
+                        os.remove(os.path.join(self.output_dir, f))
+                    except (IOError, OSError) as ioe:
+                        logger.warning('Error removing {0!s}: {1!s}'.format(f, str(ioe)))
+
+        return files_generated
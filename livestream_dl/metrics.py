@@ -0,0 +1,126 @@
+"""
+Optional HTTP endpoint that serves the state of the running downloads
+in the Prometheus text format, e.g. for alerting on stalled downloads.
+
+Each download registers a function that returns its current values when
+the endpoint is scraped, so nothing is computed between scrapes.
+"""
+import threading
+try:
+    # py2
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    # py3
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# name, type, help
+METRICS = (
+    ('livestream_segments_downloaded_total', 'counter', 'Segment files downloaded.'),
+    ('livestream_bytes_written_total', 'counter', 'Bytes of segment files written.'),
+    ('livestream_segment_lag_seconds', 'gauge',
+     'Seconds since the oldest segment listed in the manifest that is not downloaded yet was first listed.'),
+    ('livestream_mpd_poll_failures_total', 'counter', 'Failed manifest downloads.'),
+    ('livestream_broadcast_active', 'gauge', '1 if the last heartbeat reported the broadcast as active, else 0.'),
+    ('livestream_viewers', 'gauge', 'Viewer count from the last heartbeat.'),
+    ('livestream_comments_collected', 'gauge', 'Comments collected.'),
+    ('livestream_comment_poll_latency_seconds', 'gauge', 'Duration of the last comments api call.'),
+)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class MetricsServer(object):
+    """
+    Serves the metrics of the registered downloads at any path, labelled by broadcast ID.
+
+    :param port: port to listen on
+    :param host: address to listen on, default all
+    :param logger:
+    """
+
+    def __init__(self, port, host='', logger=None):
+        self.port = port
+        self.host = host
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.collectors = {}
+        self.server = None
+
+    def register(self, broadcast_id, collect):
+        """
+        Add a download.
+
+        :param broadcast_id:
+        :param collect: function that returns a dict of metric name to current value.
+            Metrics that are missing or None are not reported.
+        """
+        with self.lock:
+            self.collectors[str(broadcast_id)] = collect
+
+    def unregister(self, broadcast_id):
+        with self.lock:
+            self.collectors.pop(str(broadcast_id), None)
+
+    def render(self):
+        """The metrics in the Prometheus text exposition format."""
+        with self.lock:
+            collectors = sorted(self.collectors.items())
+        samples = []
+        for broadcast_id, collect in collectors:
+            try:
+                samples.append((broadcast_id, collect()))
+            except Exception as e:
+                if self.logger:
+                    self.logger.warning('Error collecting metrics for %s: %s' % (broadcast_id, e))
+
+        lines = [
+            '# HELP livestream_downloads Downloads in progress.',
+            '# TYPE livestream_downloads gauge',
+            'livestream_downloads %d' % len(samples),
+        ]
+        for name, metric_type, help_text in METRICS:
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            for broadcast_id, values in samples:
+                value = values.get(name)
+                if value is not None:
+                    lines.append('%s{broadcast_id="%s"} %s' % (name, broadcast_id, repr(float(value))))
+        return '\n'.join(lines) + '\n'
+
+    def start(self):
+        """Serve in a daemon thread."""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                # don't log every scrape
+                pass
+
+        self.server = _ThreadingHTTPServer((self.host, self.port), Handler)
+        worker = threading.Thread(target=self.server.serve_forever)
+        worker.daemon = True
+        worker.start()
+        if self.logger:
+            self.logger.info('Serving metrics on port %d' % self.server.server_address[1])
+        return self
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
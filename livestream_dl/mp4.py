@@ -0,0 +1,105 @@
+"""
+Minimal ISO BMFF (mp4) box reader, just enough to get the video resolution
+from an init segment without having to probe it with ffmpeg.
+"""
+import os
+import struct
+
+CONTAINER_BOXES = ('moov', 'trak', 'mdia', 'minf', 'stbl')
+VIDEO_SAMPLE_ENTRIES = ('avc1', 'avc3', 'hvc1', 'hev1')
+
+
+def iter_boxes(f, end):
+    """
+    Iterate through the boxes in the file object up to the end offset.
+
+    Yields a tuple of (box type, payload start offset, box end offset). The
+    file position is moved to the end of the box before the next one is read
+    so the caller is free to read the payload.
+    """
+    while f.tell() + 8 <= end:
+        start = f.tell()
+        size, box_type = struct.unpack('>I4s', f.read(8))
+        header_size = 8
+        if size == 1:
+            # 64-bit largesize
+            size = struct.unpack('>Q', f.read(8))[0]
+            header_size = 16
+        elif size == 0:
+            # box extends to the end
+            size = end - start
+        if size < header_size:
+            # corrupt box
+            return
+        yield box_type.decode('latin-1'), start + header_size, start + size
+        f.seek(start + size)
+
+
+def _read_tkhd(f):
+    version = struct.unpack('>B', f.read(1))[0]
+    # flags, creation/modification time, track ID, reserved, duration
+    f.seek(3 + (32 if version == 1 else 20), os.SEEK_CUR)
+    # reserved, layer, alternate group, volume, reserved, matrix
+    f.seek(8 + 2 + 2 + 2 + 2 + 36, os.SEEK_CUR)
+    width, height = struct.unpack('>II', f.read(8))
+    # 16.16 fixed point
+    return width >> 16, height >> 16
+
+
+def _read_stsd(f, end):
+    # version, flags, entry count
+    f.seek(8, os.SEEK_CUR)
+    for box_type, payload_start, _ in iter_boxes(f, end):
+        if box_type in VIDEO_SAMPLE_ENTRIES:
+            # reserved, data reference index, pre defined, reserved
+            f.seek(payload_start + 6 + 2 + 16)
+            return struct.unpack('>HH', f.read(4))
+    return None
+
+
+def _read_track(f, end, track):
+    for box_type, payload_start, box_end in iter_boxes(f, end):
+        if box_type in CONTAINER_BOXES:
+            _read_track(f, box_end, track)
+        elif box_type == 'tkhd':
+            track['tkhd'] = _read_tkhd(f)
+        elif box_type == 'hdlr':
+            # version, flags, pre defined
+            f.seek(payload_start + 8)
+            track['handler'] = f.read(4).decode('latin-1')
+        elif box_type == 'stsd':
+            track['sample_entry'] = _read_stsd(f, box_end)
+    return track
+
+
+def get_video_resolution(file_path):
+    """
+    Get the (width, height) of the video track in an mp4/m4v file.
+
+    The sample entry (avc1, etc) dimensions are preferred since they are the
+    coded size reported by ffmpeg. The track header (tkhd) dimensions are used
+    otherwise.
+
+    :raises IOError: if the file does not have a moov box with a video track,
+        i.e. it is not an init segment
+    """
+    with open(file_path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        file_size = f.tell()
+        f.seek(0)
+        try:
+            for box_type, _, box_end in iter_boxes(f, file_size):
+                if box_type != 'moov':
+                    continue
+                for trak_type, _, trak_end in iter_boxes(f, box_end):
+                    if trak_type != 'trak':
+                        continue
+                    track = _read_track(f, trak_end, {})
+                    if track.get('sample_entry'):
+                        return track['sample_entry']
+                    if track.get('handler') == 'vide' and track.get('tkhd'):
+                        return track['tkhd']
+        except struct.error:
+            # truncated box
+            pass
+    raise IOError('No video track found in {0!s}'.format(file_path))
@@ -0,0 +1,172 @@
+"""
+Pooled HTTP sessions for the dash downloaders.
+
+All sessions share a single connection pool so that keep-alive connections to
+the video hosts are reused across the mpd polls and segment downloads of every
+broadcast. Each session records its own request timings.
+"""
+import time
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.compat import urlparse
+
+# max connections kept alive per host
+POOL_MAXSIZE = 50
+
+_shared_adapter = None
+_shared_adapter_lock = threading.Lock()
+
+
+class DownloadAborted(KeyboardInterrupt):
+    """
+    Raised in a download thread when its session has been aborted so that
+    it is handled like a CTRL+C in that thread.
+    """
+
+
+class RequestStats(object):
+    """
+    Per host request timings.
+
+    ``headers_time`` is the time from sending the request to receiving the
+    response headers, i.e. it includes any connect and TLS handshake.
+    ``transfer_time`` is the time taken to then read the response body.
+    The body of streamed requests is timed and sized as the caller reads it.
+    """
+
+    FIELDS = ('requests', 'errors', 'bytes', 'headers_time', 'transfer_time', 'max_time')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hosts = {}
+
+    def _host_stats(self, host):
+        stats = self.hosts.get(host)
+        if not stats:
+            stats = dict([(field, 0) for field in self.FIELDS])
+            self.hosts[host] = stats
+        return stats
+
+    def record(self, host, headers_time, transfer_time, size):
+        with self.lock:
+            stats = self._host_stats(host)
+            stats['requests'] += 1
+            stats['bytes'] += size
+            stats['headers_time'] += headers_time
+            stats['transfer_time'] += transfer_time
+            stats['max_time'] = max(stats['max_time'], headers_time + transfer_time)
+
+    def record_transfer(self, host, headers_time, transfer_time, size):
+        """Add the body read of a streamed request that has already been recorded."""
+        with self.lock:
+            stats = self._host_stats(host)
+            stats['bytes'] += size
+            stats['transfer_time'] += transfer_time
+            stats['max_time'] = max(stats['max_time'], headers_time + transfer_time)
+
+    def record_error(self, host):
+        with self.lock:
+            self._host_stats(host)['errors'] += 1
+
+    def totals(self):
+        """Stats summed across all hosts."""
+        totals = dict([(field, 0) for field in self.FIELDS])
+        with self.lock:
+            for stats in self.hosts.values():
+                for field in self.FIELDS:
+                    if field == 'max_time':
+                        totals[field] = max(totals[field], stats[field])
+                    else:
+                        totals[field] += stats[field]
+        return totals
+
+    def __str__(self):
+        totals = self.totals()
+        count = totals['requests'] or 1
+        return '%d requests (%d errors), %.1fMB, avg %dms to headers + %dms transfer, max %dms' % (
+            totals['requests'], totals['errors'], totals['bytes'] / 1024.0 / 1024.0,
+            1000 * totals['headers_time'] / count, 1000 * totals['transfer_time'] / count,
+            1000 * totals['max_time'])
+
+
+class TimedSession(requests.Session):
+    """
+    requests Session that records the timings of every request.
+
+    It can be aborted from another thread with abort(), after which requests
+    and the reading of streamed bodies raise DownloadAborted.
+    """
+
+    def __init__(self, stats=None):
+        super(TimedSession, self).__init__()
+        self.stats = stats or RequestStats()
+        self.aborted = threading.Event()
+
+    def abort(self):
+        self.aborted.set()
+
+    def _check_aborted(self):
+        if self.aborted.is_set():
+            raise DownloadAborted('Download aborted')
+
+    def send(self, request, **kwargs):
+        self._check_aborted()
+        host = urlparse(request.url).netloc
+        start = time.time()
+        try:
+            res = super(TimedSession, self).send(request, **kwargs)
+        except requests.RequestException:
+            self.stats.record_error(host)
+            raise
+        headers_time = res.elapsed.total_seconds()
+        if kwargs.get('stream'):
+            self.stats.record(host, headers_time, 0.0, 0)
+            self._time_stream(res, host, headers_time)
+        else:
+            transfer_time = max(0.0, time.time() - start - headers_time)
+            self.stats.record(host, headers_time, transfer_time, len(res.content or b''))
+        return res
+
+    def _time_stream(self, res, host, headers_time):
+        """Record the transfer time and size of a streamed body as it is read with iter_content."""
+        iter_content = res.iter_content
+        stats = self.stats
+        check_aborted = self._check_aborted
+
+        def timed_iter_content(*args, **kwargs):
+            start = time.time()
+            size = 0
+            try:
+                for chunk in iter_content(*args, **kwargs):
+                    check_aborted()
+                    size += len(chunk)
+                    yield chunk
+            finally:
+                stats.record_transfer(host, headers_time, time.time() - start, size)
+
+        # Response.content also reads through iter_content
+        res.iter_content = timed_iter_content
+
+
+def shared_adapter():
+    """The HTTPAdapter, and its connection pool, shared by all sessions."""
+    global _shared_adapter
+    with _shared_adapter_lock:
+        if _shared_adapter is None:
+            _shared_adapter = HTTPAdapter(max_retries=2, pool_maxsize=POOL_MAXSIZE)
+        return _shared_adapter
+
+
+def create_session(stats=None):
+    """
+    Create a TimedSession that uses the shared connection pool.
+
+    :param stats: optional RequestStats to record to
+    """
+    session = TimedSession(stats=stats)
+    adapter = shared_adapter()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
@@ -0,0 +1,20 @@
+from instagram_private_api_extensions.replay import Downloader
+
+
+class ReplayDownloader(Downloader):
+    """
+    Replay Downloader that can be stopped from another thread, like the live Downloader.
+    Requires a session that can be aborted, i.e. a ``net.TimedSession``.
+    """
+
+    def __init__(self, mpd, output_dir, user_agent=None, **kwargs):
+        # TimedSession to use instead of the downloader's own
+        session = kwargs.pop('session')
+        super(ReplayDownloader, self).__init__(mpd, output_dir, user_agent=user_agent, **kwargs)
+        self.session = session
+        self.is_aborted = False
+
+    def stop(self):
+        """Abort the download in progress. DownloadAborted is raised in the downloading thread."""
+        self.is_aborted = True
+        self.session.abort()
@@ -0,0 +1,83 @@
+import os
+import json
+import time
+import threading
+
+
+class UserIdCache(object):
+    """
+    Maps IG user names to numeric user IDs so that the username_info api call
+    can be skipped. Entries expire after ``ttl`` seconds since user names can be
+    changed and then taken by another account.
+    """
+
+    TTL = 24 * 60 * 60
+
+    def __init__(self, file_path=None, ttl=None, logger=None):
+        """
+
+        :param file_path: json file to persist the cache to. If None, the cache is only kept in memory.
+        :param ttl: seconds before an entry expires. None for entries to never expire.
+        :param logger:
+        """
+        self.file_path = file_path
+        self.ttl = ttl
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.entries = {}
+        if file_path and os.path.isfile(file_path):
+            try:
+                with open(file_path) as cache_file:
+                    self.entries = json.load(cache_file)
+            except (ValueError, IOError, OSError) as e:
+                # corrupt cache, start afresh
+                if self.logger:
+                    self.logger.warning('Unable to read %s: %s' % (file_path, e))
+
+    @staticmethod
+    def path_for(settings_file_path):
+        """File path of the cache for a settings json file, e.g. myusername_users.json"""
+        return os.path.splitext(settings_file_path)[0] + '_users.json'
+
+    def _save(self):
+        if not self.file_path:
+            return
+        with open(self.file_path, 'w') as cache_file:
+            json.dump(self.entries, cache_file, indent=2)
+
+    def get(self, username):
+        """Get the cached user ID, or None if it is not cached or has expired."""
+        with self.lock:
+            entry = self.entries.get(username.lower())
+        if not entry:
+            return None
+        if self.ttl is not None and time.time() - entry['cached_at'] > self.ttl:
+            return None
+        return entry['pk']
+
+    def set(self, username, user_id):
+        with self.lock:
+            self.entries[username.lower()] = {'pk': str(user_id), 'cached_at': int(time.time())}
+            self._save()
+
+    def invalidate(self, username):
+        with self.lock:
+            if self.entries.pop(username.lower(), None):
+                self._save()
+
+    def lookup(self, api, username):
+        """
+        Get the numeric user ID for a user name, calling the api only if it is not cached.
+        The cached entry is invalidated if the api call fails.
+        """
+        user_id = self.get(username)
+        if user_id:
+            return user_id
+        try:
+            user_res = api.username_info(username)
+        except Exception:
+            self.invalidate(username)
+            raise
+        user_id = str(user_res['user']['pk'])
+        self.set(username, user_id)
+        return user_id
@@ -1,4 +1,5 @@
 import logging
+import time
 import json
 import codecs
 import sys
@@ -6,8 +7,16 @@ import os
 import re
 import itertools
 import warnings
+from collections import OrderedDict
 
-from instagram_private_api.compat import compat_urllib_request
+try:
+    # py2
+    from ConfigParser import SafeConfigParser
+except ImportError:
+    # py3
+    from configparser import SafeConfigParser
+
+from .filters import CommentFilter
 
 
 class TerminalColors:
@@ -25,6 +34,8 @@ class Formatter(logging.Formatter):
 
     def __init__(self, fmt=None, datefmt=None):
         super(Formatter, self).__init__(fmt, datefmt)
+        # detected once instead of for every record
+        self.use_color = self.supports_color()
 
     @staticmethod
     def supports_color():
@@ -44,8 +55,8 @@ class Formatter(logging.Formatter):
         return True
 
     def format(self, record):
-        if not self.supports_color():
-            return str(record.msg)
+        if not self.use_color:
+            return str(record.getMessage())
 
         color = ''
         if record.levelno == logging.ERROR:
@@ -54,16 +65,177 @@ class Formatter(logging.Formatter):
             color = TerminalColors.OKGREEN
         if record.levelno == logging.WARNING:
             color = TerminalColors.WARNING
-        return color + str(record.msg) + TerminalColors.ENDC
+        return color + str(record.getMessage()) + TerminalColors.ENDC
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats each record as a json object on a single line, including any
+    extra fields of the record, e.g. broadcast_id, segment and latency.
+    """
+
+    # attributes of every LogRecord, i.e. not extra fields
+    RECORD_ATTRS = frozenset(
+        list(logging.LogRecord('', logging.INFO, '', 0, '', None, None).__dict__.keys()) + ['message', 'asctime'])
+
+    def format(self, record):
+        data = {
+            'time': round(record.created, 3),
+            'level': record.levelname,
+            'logger': os.path.basename(record.name),
+            'message': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in self.RECORD_ATTRS and not key.startswith('_'):
+                data[key] = value
+        if record.exc_info:
+            data['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str, sort_keys=True)
+
+
+def start_log_listener(loggers, handlers):
+    """
+    Route the records of the loggers through a queue to the handlers, which are
+    then written to by a listener thread so that the download threads don't block
+    on console and disk writes. The listener is stopped, and the queue flushed, at exit.
+    On py2, which has no QueueHandler, the handlers are used directly instead.
+
+    :param loggers: list of loggers
+    :param handlers: list of handlers. They are removed from the loggers if already added.
+    :return: the QueueListener, or None on py2
+    """
+    try:
+        # py3
+        from logging.handlers import QueueHandler, QueueListener
+        from queue import Queue
+    except ImportError:
+        # py2
+        for lgr in loggers:
+            for handler in handlers:
+                if handler not in lgr.handlers:
+                    lgr.addHandler(handler)
+        return None
+
+    import atexit
+
+    log_queue = Queue(-1)
+    queue_handler = QueueHandler(log_queue)
+    for lgr in loggers:
+        for handler in handlers:
+            lgr.removeHandler(handler)
+        lgr.addHandler(queue_handler)
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+class PhaseTimer(object):
+    """
+    Measures how long each phase takes, e.g. the startup phases
+    before the first manifest is downloaded.
+    """
+
+    def __init__(self, start_time=None):
+        self.start_time = start_time or time.time()
+        self.last_time = self.start_time
+        self.phases = []
+
+    def mark(self, phase):
+        """End the current phase, which started when the previous phase ended."""
+        now = time.time()
+        self.phases.append((phase, now - self.last_time))
+        self.last_time = now
+
+    @property
+    def elapsed(self):
+        return self.last_time - self.start_time
+
+    def as_dict(self):
+        """Duration in seconds of each phase, in order. Durations of repeated phases are summed."""
+        durations = OrderedDict()
+        for phase, duration in self.phases:
+            durations[phase] = round(durations.get(phase, 0) + duration, 3)
+        return durations
+
+    def __str__(self):
+        return '%s (total %.2fs)' % (
+            ', '.join(['%s %.2fs' % (phase, duration) for phase, duration in self.phases]),
+            self.elapsed)
+
+
+class ResolvedConfig(object):
+    """
+    Read-only snapshot of the UserConfig values, resolved once so that
+    reading a setting is just an attribute lookup.
+    """
+
+    __slots__ = (
+        'settings', 'username', 'password', 'outputdir', 'commenters',
+        'collectcomments', 'nocleanup', 'openwhendone', 'mpdtimeout',
+        'downloadtimeout', 'verbose', 'ffmpegbinary', 'skipffmpeg',
+        'incremental', 'log', 'filenameformat', 'noreplay', 'watchlist',
+        'watchinterval', 'nobatchcheck', 'commentkeywords',
+        'excludecommenters', 'replayworkers', 'usercachettl',
+        'nousercache', 'metricsport', 'logformat',
+    )
+
+    def __init__(self, **values):
+        for key in self.__slots__:
+            object.__setattr__(self, key, values.get(key))
+
+    def __setattr__(self, key, value):
+        raise AttributeError('ResolvedConfig is read-only')
+
+    def __delattr__(self, key):
+        raise AttributeError('ResolvedConfig is read-only')
+
+    def __str__(self):
+        return 'ResolvedConfig(%s)' % ', '.join([
+            '%s=%s' % (key, getattr(self, key) if key not in ('commenters', 'excludecommenters')
+                       else '[%s]' % ','.join(sorted(getattr(self, key))))
+            for key in self.__slots__])
 
 
 class UserConfig(object):
 
-    def __init__(self, section, defaults, argparser=None, configparser=None):
+    def __init__(self, section, defaults, argparser=None, configparser=None, config_file=None):
         self.section = section
         self.defaults = defaults
         self.argparse = argparser
         self.configparser = configparser
+        self.config_file = config_file
+        self._config_file_mtime = self._get_config_file_mtime()
+
+    def _get_config_file_mtime(self):
+        if self.config_file and os.path.isfile(self.config_file):
+            return os.path.getmtime(self.config_file)
+        return None
+
+    def resolve(self):
+        """Resolve all the settings once into a ResolvedConfig."""
+        values = dict([(key, getattr(self, key)) for key in ResolvedConfig.__slots__])
+        for key in ('commenters', 'excludecommenters'):
+            values[key] = frozenset(values[key] or [])
+        values['commentkeywords'] = tuple(values['commentkeywords'] or [])
+        # fail on invalid patterns now rather than when a download starts
+        CommentFilter.compile_keywords(values['commentkeywords'])
+        return ResolvedConfig(**values)
+
+    def has_changed(self):
+        """Check if the config file has been modified since it was last read."""
+        return bool(self.config_file) and self._get_config_file_mtime() != self._config_file_mtime
+
+    def reload(self):
+        """Read the config file again and return the newly resolved config."""
+        self._config_file_mtime = self._get_config_file_mtime()
+        if self._config_file_mtime is None:
+            self.configparser = None
+        else:
+            configparser = SafeConfigParser()
+            configparser.read(self.config_file)
+            self.configparser = configparser
+        return self.resolve()
 
     def get(self, key, type=None):
         value = None
@@ -113,9 +285,20 @@ class UserConfig(object):
             'verbose=%s' % self.verbose,
             'ffmpegbinary=%s' % self.ffmpegbinary,
             'skipffmpeg=%s' % self.skipffmpeg,
+            'incremental=%s' % self.incremental,
             'log=%s' % self.log,
+            'logformat=%s' % self.logformat,
             'filenameformat=%s' % self.filenameformat,
             'noreplay=%s' % self.noreplay,
+            'watchlist=%s' % self.watchlist,
+            'watchinterval=%s' % self.watchinterval,
+            'nobatchcheck=%s' % self.nobatchcheck,
+            'commentkeywords=[%s]' % ','.join(self.commentkeywords),
+            'excludecommenters=[%s]' % ','.join(self.excludecommenters),
+            'replayworkers=%s' % self.replayworkers,
+            'usercachettl=%s' % self.usercachettl,
+            'nousercache=%s' % self.nousercache,
+            'metricsport=%s' % self.metricsport,
         ])
 
     @property
@@ -166,6 +349,10 @@ class UserConfig(object):
     def skipffmpeg(self):
         return self.get('skipffmpeg', type=bool)
 
+    @property
+    def incremental(self):
+        return self.get('incremental', type=bool)
+
     @property
     def ffmpegbinary(self):
         return self.get('ffmpegbinary')
@@ -174,6 +361,10 @@ class UserConfig(object):
     def log(self):
         return self.get('log')
 
+    @property
+    def logformat(self):
+        return self.get('logformat')
+
     @property
     def filenameformat(self):
         return self.get('filenameformat')
@@ -182,11 +373,77 @@ class UserConfig(object):
     def noreplay(self):
         return self.get('noreplay', type=bool)
 
+    @property
+    def watchlist(self):
+        return self.get('watchlist')
+
+    @property
+    def watchinterval(self):
+        return self.get('watchinterval', type=int)
+
+    @property
+    def nobatchcheck(self):
+        return self.get('nobatchcheck', type=bool)
+
+    @property
+    def commentkeywords(self):
+        value = self.get('commentkeywords')
+        if value and not isinstance(value, list):
+            # one pattern per line in the config file since patterns can contain commas, e.g. a{1,3}
+            value = [k.strip() for k in value.splitlines() if k.strip()]
+        return value
+
+    @property
+    def excludecommenters(self):
+        return self.get('excludecommenters', type=list)
+
+    @property
+    def replayworkers(self):
+        return self.get('replayworkers', type=int)
+
+    @property
+    def usercachettl(self):
+        return self.get('usercachettl', type=int)
+
+    @property
+    def nousercache(self):
+        return self.get('nousercache', type=bool)
+
+    @property
+    def metricsport(self):
+        return self.get('metricsport', type=int)
+
+
+def network_errors():
+    """
+    Exceptions raised for (probably transient) network errors.
+    Imported on first use since ssl and http are slow to import.
+    Except clauses are only evaluated when an exception is raised, so
+    ``except network_errors()`` does not cost anything otherwise.
+    """
+    from socket import timeout, error as SocketError
+    from ssl import SSLError
+    try:
+        # py2
+        from urllib2 import URLError
+        from httplib import HTTPException
+    except ImportError:
+        # py3
+        from urllib.error import URLError
+        from http.client import HTTPException
+    return SSLError, timeout, URLError, HTTPException, SocketError
+
 
 def check_for_updates(current_version):
+    try:
+        # py2
+        from urllib2 import urlopen
+    except ImportError:
+        # py3
+        from urllib.request import urlopen
     try:
         repo = 'taengstagram/instagram-livestream-downloader'
-        res = compat_urllib_request.urlopen('https://api.github.com/repos/%s/releases' % repo)
+        res = urlopen('https://api.github.com/repos/%s/releases' % repo)
         json_res = res.read().decode('utf-8')
         releases = json.loads(json_res)
         if not releases:
@@ -223,7 +480,19 @@ def from_json(json_object):
     return json_object
 
 
-def generate_safe_path(name, parent_path, is_file=True):
+def generate_safe_path(name, parent_path, is_file=True, exclude=None, companion_exts=None):
+    """
+    Generate a path that does not exist yet by appending a numeric suffix if required.
+
+    :param name: file/folder name
+    :param parent_path: parent folder
+    :param is_file: bool flag to indicate that name is a file
+    :param exclude: optional list of paths to treat as existing, e.g. paths already reserved
+    :param companion_exts: optional list of extensions, e.g. ['jsonl'], that must also be free
+        for the generated path, for files that are derived from it
+    """
+    exclude = exclude or []
+    companion_exts = companion_exts or []
     mobj = re.match(r'(?P<nm>.*)\.(?P<ext>[a-z0-9]+)?$', name)
 
     if not is_file or not mobj:
@@ -246,5 +515,9 @@ def generate_safe_path(name, parent_path, is_file=True):
                 target_name = '%s-%s%s' % (name_sans_ext, s, ('.%s' % ext) if ext else '')
             else:
                 target_name = '%s-%s' % (name_sans_ext, s)
-        if not os.path.exists(os.path.join(parent_path, target_name)):
-            return os.path.join(parent_path, target_name)
+        target_path = os.path.join(parent_path, target_name)
+        companion_paths = [
+            '%s.%s' % (os.path.splitext(target_path)[0], companion_ext) for companion_ext in companion_exts]
+        if not os.path.exists(target_path) and target_path not in exclude and \
+                not [p for p in companion_paths if os.path.exists(p)]:
+            return target_path
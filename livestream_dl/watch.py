@@ -0,0 +1,207 @@
+import time
+import threading
+
+from .discovery import get_broadcasts, discover_broadcasts
+from .usercache import UserIdCache
+from .utils import network_errors
+
+
+def read_watch_list(file_path):
+    """
+    Read the list of IG user names/IDs to watch.
+    One user per line. Blank lines and lines starting with # are ignored.
+    """
+    watch_list = []
+    with open(file_path) as watch_file:
+        for line in watch_file:
+            user = line.strip()
+            if user and not user.startswith('#') and user not in watch_list:
+                watch_list.append(user)
+    return watch_list
+
+
+class Watcher(object):
+    """
+    Polls a list of IG users with a single api client and starts a
+    download as soon as a broadcast is found.
+    """
+
+    INTERVAL = 60
+
+    def __init__(self, api, watch_list, on_broadcast, logger, userconfig,
+                 config_source=None, relogin=None, user_cache=None):
+        """
+
+        :param api: Client instance
+        :param watch_list: list of IG user names or numeric user IDs
+        :param on_broadcast: function(api, broadcast, userconfig, downloaders) that downloads the broadcast
+        :param logger:
+        :param userconfig: ResolvedConfig instance. The watchinterval, noreplay,
+            nobatchcheck and replayworkers settings are used by the watcher. If
+            nobatchcheck is not set, all users are checked with a single api call,
+            which only works for users followed by the logged in account.
+        :param config_source: optional UserConfig instance. The config is reloaded
+            when the config file is modified.
+        :param relogin: function that returns a freshly logged in Client instance
+        :param user_cache: optional UserIdCache instance. If not set, user IDs are
+            cached in memory only.
+        """
+        self.api = api
+        self.watch_list = watch_list
+        self.on_broadcast = on_broadcast
+        self.logger = logger
+        self.userconfig = userconfig
+        self.config_source = config_source
+        self.relogin = relogin
+        self.user_cache = user_cache or UserIdCache()
+        # user ID => watch list entry, for the user IDs from the cache in the current poll
+        self.cached_users = {}
+        # (broadcast ID, 'live' or 'replay') of the downloads already started
+        self.handled = set()
+        self.workers = {}
+        self.downloaders = {}
+        # limits the number of replays downloading at the same time, live broadcasts are never queued
+        self.replay_slots = threading.BoundedSemaphore(max(1, userconfig.replayworkers or 1))
+        self.is_aborted = False
+
+    @property
+    def interval(self):
+        return self.userconfig.watchinterval or self.INTERVAL
+
+    def reload_config(self):
+        """Pick up changes to the config file. Only new downloads use the new config."""
+        if self.config_source and self.config_source.has_changed():
+            try:
+                self.userconfig = self.config_source.reload()
+            except ValueError as e:
+                self.logger.error('Config not reloaded: %s' % e)
+                return
+            self.logger.info('Reloaded config.')
+
+    def resolve_user_id(self, user):
+        """Get the numeric IG user ID for a watch list entry."""
+        if user.isdigit():
+            return user
+        is_cached = bool(self.user_cache.get(user))
+        user_id = self.user_cache.lookup(self.api, user)
+        if is_cached:
+            self.cached_users[str(user_id)] = user
+        return user_id
+
+    def get_user_feed(self, user_id):
+        """Get a user's story feed. A cached user ID is looked up again on the next poll if the call fails."""
+        from instagram_private_api import ClientError, ClientLoginRequiredError
+        try:
+            return self.api.user_story_feed(user_id)
+        except ClientLoginRequiredError:
+            raise
+        except ClientError:
+            user = self.cached_users.get(str(user_id))
+            if user:
+                # the user name may now belong to another account
+                self.user_cache.invalidate(user)
+            raise
+
+    def call_api(self, description, func, *args):
+        """
+        Make an api call, logging in again if required.
+        Errors are logged and None is returned so that polling can carry on.
+        """
+        from instagram_private_api import ClientError, ClientLoginRequiredError
+        try:
+            return func(*args)
+        except ClientLoginRequiredError:
+            if not self.relogin:
+                raise
+            self.logger.warning('ClientLoginRequiredError. Logging in again...')
+            self.api = self.relogin()
+        except ClientError as e:
+            self.logger.warning('Error checking %s: %d %s' % (description, e.code, e.error_response))
+        except network_errors() as e:
+            self.logger.warning('Error checking %s: %s' % (description, e))
+        return None
+
+    def poll(self):
+        """Check every user in the watch list once."""
+        user_ids = []
+        self.cached_users = {}
+        for user in self.watch_list:
+            ig_user_id = self.call_api(user, self.resolve_user_id, user)
+            if ig_user_id:
+                user_ids.append(ig_user_id)
+
+        if not self.userconfig.nobatchcheck and len(user_ids) > 1:
+            feeds = self.call_api('watch list', discover_broadcasts, self.api, user_ids) or {}
+            feeds = [feeds.get(user_id) or {} for user_id in user_ids]
+        else:
+            feeds = []
+            for user_id in user_ids:
+                if self.is_aborted:
+                    break
+                feeds.append(self.call_api(user_id, self.get_user_feed, user_id) or {})
+
+        for res in feeds:
+            for broadcast in get_broadcasts(res, noreplay=self.userconfig.noreplay):
+                self.start(broadcast)
+
+    def start(self, broadcast):
+        """Start downloading a broadcast in its own thread if it isn't already handled."""
+        broadcast_id = broadcast['id']
+        worker = self.workers.get(broadcast_id)
+        if worker and worker.is_alive():
+            return
+        is_post_live = broadcast.get('broadcast_status') == 'post_live'
+        handled_key = (broadcast_id, 'replay' if is_post_live else 'live')
+        if handled_key in self.handled:
+            return
+
+        # Only attempt a live or replay download once. A live download can end, e.g. if the
+        # stream stalls, while the broadcast is still listed as active, and downloading it
+        # again would duplicate or overwrite the output files.
+        self.handled.add(handled_key)
+        target = self.on_broadcast
+        if is_post_live:
+            target = self.download_replay
+        self.logger.info(
+            'Broadcast found for %s (%s)' % (broadcast['broadcast_owner']['username'], broadcast_id))
+        worker = threading.Thread(
+            target=target, name=str(broadcast_id),
+            args=(self.api, broadcast, self.userconfig, self.downloaders))
+        worker.start()
+        self.workers[broadcast_id] = worker
+
+    def download_replay(self, api, broadcast, userconfig, downloaders):
+        """Wait for a free replay slot before downloading."""
+        with self.replay_slots:
+            if self.is_aborted:
+                return
+            self.on_broadcast(api, broadcast, userconfig, downloaders)
+
+    def run(self):
+        """Poll the watch list until interrupted."""
+        self.logger.info('Watching %d user(s) every %ds' % (len(self.watch_list), self.interval))
+        self.logger.info('[i] To stop watching, press CTRL+C')
+        try:
+            while not self.is_aborted:
+                poll_start = time.time()
+                self.reload_config()
+                self.poll()
+                # clear finished workers
+                for broadcast_id in [k for k, t in self.workers.items() if not t.is_alive()]:
+                    self.workers.pop(broadcast_id)
+                    self.downloaders.pop(broadcast_id, None)
+                time.sleep(max(0, self.interval - (time.time() - poll_start)))
+        except KeyboardInterrupt:
+            self.logger.warning('Watch interrupted.')
+        finally:
+            self.stop()
+
+    def stop(self):
+        """Stop polling and wait for the downloads in progress to complete."""
+        self.is_aborted = True
+        for dl in list(self.downloaders.values()):
+            if not dl.is_aborted:
+                dl.stop()
+        for worker in list(self.workers.values()):
+            if worker.is_alive():
+                worker.join()
@@ -38,7 +38,8 @@ setup(
         '#egg=instagram_private_api_extensions-%(ext)s' % {'ext': _api_extensions_version}
     ],
     extras_require={
-        'AS': ['moviepy>=0.2.3.2'],
+        # moviepy is no longer required, extra kept for compatibility
+        'AS': [],
     },
     include_package_data=True,
     platforms='any',